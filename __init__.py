@@ -1,11 +1,18 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import ir
+from . import location
 from . import lot
+from . import product
 from . import stock
 
 def register():
     Pool.register(
+        ir.Cron,
         lot.Lot,
+        lot.LotFifoQuantity,
+        location.Location,
+        product.Category,
         stock.Move,
         module='stock_lot_fifo', type_='model')
@@ -0,0 +1,17 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('stock.lot|backfill_fifo_dates', "Compute Lot FIFO Dates"),
+                ('stock.lot.fifo.quantity|rebuild',
+                    "Rebuild Lot FIFO Quantities"),
+                ('stock.move|assign_try_lots', "Assign Moves with Lot"),
+                ])
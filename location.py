@@ -0,0 +1,80 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.model import fields
+from trytond.pool import PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+from .lot import FIFO_STRATEGIES
+from .tools import get_stats
+
+
+class Location(metaclass=PoolMeta):
+    __name__ = 'stock.location'
+    fifo_strategy = fields.Selection(FIFO_STRATEGIES, "FIFO Strategy",
+        states={
+            'invisible': Eval('type') != 'warehouse',
+            },
+        help="The order in which the lots are assigned in the warehouse "
+        "when the category of the product does not define it.")
+    _fifo_rank_cache = Cache('stock.location.fifo_rank', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, locations, field_names=None):
+        super().on_modification(mode, locations, field_names=field_names)
+        cls._fifo_rank_cache.clear()
+
+    @classmethod
+    def get_fifo_ranks(cls, location_id):
+        """Return a dictionary with the rank of each location id in the
+        warehouse of location id
+
+        The rank is the position of the location in the tree of the warehouse
+        so the locations which are close in the tree have close ranks.
+        """
+        warehouses = cls._fifo_rank_cache.get(None)
+        ranks = None
+        if warehouses is not None:
+            warehouse = warehouses.get(location_id)
+            if warehouse is None:
+                return {}
+            ranks = cls._fifo_rank_cache.get(warehouse)
+        if ranks is None:
+            warehouses, ranks = cls._set_fifo_ranks()
+            ranks = ranks.get(warehouses.get(location_id), {})
+        return ranks
+
+    @classmethod
+    def get_fifo_warehouse(cls, location_id):
+        "Return the warehouse id of location id from the cache of the ranks"
+        warehouses = cls._fifo_rank_cache.get(None)
+        if warehouses is None:
+            warehouses, _ = cls._set_fifo_ranks()
+        return warehouses.get(location_id)
+
+    @classmethod
+    def _set_fifo_ranks(cls):
+        """Cache and return the warehouse of each location and the ranks of
+        the locations of each warehouse"""
+        cursor = Transaction().connection.cursor()
+        warehouse = cls.__table__()
+        location = cls.__table__()
+
+        get_stats().add('location_rank_queries')
+        cursor.execute(*warehouse.join(location,
+                condition=(location.left >= warehouse.left)
+                & (location.right <= warehouse.right)
+                ).select(warehouse.id, location.id,
+                where=warehouse.type == 'warehouse',
+                order_by=[warehouse.left.asc, location.left.asc]))
+        warehouses, ranks = {}, {}
+        for warehouse_id, location_id in cursor:
+            # The deepest warehouse wins like for the warehouse field
+            warehouses[location_id] = warehouse_id
+            warehouse_ranks = ranks.setdefault(warehouse_id, {})
+            warehouse_ranks[location_id] = len(warehouse_ranks)
+        for warehouse_id, warehouse_ranks in ranks.items():
+            cls._fifo_rank_cache.set(warehouse_id, warehouse_ranks)
+        cls._fifo_rank_cache.set(None, warehouses)
+        return warehouses, ranks
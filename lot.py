@@ -1,10 +1,169 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.pool import PoolMeta
+import datetime
+import logging
+from collections import defaultdict
+
+from sql import Column, Conflict, Excluded, For, Literal, Null, Union
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Equal
+
+from trytond.cache import Cache
+from trytond.model import Exclude, Index, ModelSQL, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .tools import get_option, get_stats
+
+logger = logging.getLogger(__name__)
+
+FIFO_STRATEGIES = [
+    (None, ""),
+    ('fefo', "First Expired, First Out"),
+    ('lot_date', "First In, First Out by Lot Date"),
+    ('lifo', "Last In, First Out"),
+    ('receipt', "First In, First Out by Receipt Date"),
+    ]
 
 
 class Lot(metaclass=PoolMeta):
     __name__ = 'stock.lot'
+    fifo_date = fields.Date("FIFO Date", readonly=True,
+        help="The date used to sort the lots when assigning moves.")
+    fifo_expiration_date = fields.Date("FIFO Expiration Date", readonly=True,
+        help="The date after which the lot is not assigned to moves.")
+    receipt_date = fields.Date("Receipt Date", readonly=True,
+        help="The date of the first move which received the lot in storage.")
+    _fifo_date_cache = Cache('stock.lot.fifo_date', context=False)
+
+    # Fields used by sort_quantities_fifo by order of preference
+    _fifo_date_fields = [
+        'shelf_life_expiration_date', 'expiration_date', 'lot_date']
+    # Fields used by fifo_expiration by order of preference
+    _fifo_expiration_date_fields = [
+        'shelf_life_expiration_date', 'expiration_date']
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.product, Index.Range()),
+                (t.fifo_date, Index.Range())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        table_h = cls.__table_handler__(module_name)
+        fill_fifo_date = not table_h.column_exist('fifo_date')
+        fill_fifo_expiration_date = not table_h.column_exist(
+            'fifo_expiration_date')
+        fill_receipt_date = not table_h.column_exist('receipt_date')
+
+        super().__register__(module_name)
+
+        if fill_fifo_date:
+            cursor.execute(*table.update(
+                    [table.fifo_date],
+                    [cls._fifo_date_column(table)]))
+        expiration_column = cls._fifo_expiration_date_column(table)
+        if fill_fifo_expiration_date and expiration_column:
+            cursor.execute(*table.update(
+                    [table.fifo_expiration_date],
+                    [expiration_column]))
+        if fill_receipt_date:
+            query = cls._receipt_date_query()
+            cursor.execute(*table.update(
+                    [table.receipt_date],
+                    [query.select(query.receipt_date,
+                            where=query.lot == table.id)]))
+
+    @classmethod
+    def _fifo_date_column(cls, table):
+        "Return the SQL expression of sort_quantities_fifo"
+        columns = [Column(table, f) for f in cls._fifo_date_fields
+            if f in cls._fields]
+        if columns:
+            column = Coalesce(*columns, table.create_date)
+        else:
+            column = table.create_date
+        return cls.fifo_date.sql_cast(column)
+
+    @classmethod
+    def _fifo_expiration_date_column(cls, table):
+        "Return the SQL expression of fifo_expiration or None"
+        columns = [Column(table, f) for f in cls._fifo_expiration_date_fields
+            if f in cls._fields]
+        if len(columns) > 1:
+            return Coalesce(*columns)
+        elif columns:
+            return columns[0]
+
+    @classmethod
+    def backfill_fifo_dates(cls, chunk_size=None):
+        """
+        Compute the FIFO dates of all the lots in SQL by chunks of ids.
+        Each chunk is committed in its own transaction, so it can be run again
+        to resume after a failure or after the activation of a module which
+        adds a date used by sort_quantities_fifo.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        if chunk_size is None:
+            chunk_size = get_option('backfill_chunk', 10000)
+        cursor.execute(*table.select(Min(table.id), Max(table.id)))
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return
+        updated = 0
+        for start in range(min_id, max_id + 1, chunk_size):
+            with transaction.new_transaction():
+                updated += cls._backfill_fifo_dates(start, start + chunk_size)
+            logger.info(
+                "FIFO dates computed up to lot %d of %d, %d lots updated",
+                min(start + chunk_size - 1, max_id), max_id, updated)
+        cls._fifo_date_cache.clear()
+
+    @classmethod
+    def _backfill_fifo_dates(cls, start, end):
+        "Compute the FIFO dates of the lots with id in [start, end)"
+        pool = Pool()
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        fifo_date = cls._fifo_date_column(table)
+        fifo_expiration_date = cls._fifo_expiration_date_column(table)
+        if fifo_expiration_date is None:
+            fifo_expiration_date = Null
+        else:
+            fifo_expiration_date = cls.fifo_expiration_date.sql_cast(
+                fifo_expiration_date)
+        cursor.execute(*table.select(table.id,
+                where=(table.id >= start) & (table.id < end)
+                & ((Coalesce(table.fifo_date, datetime.date.min)
+                        != Coalesce(fifo_date, datetime.date.min))
+                    | (Coalesce(table.fifo_expiration_date, datetime.date.min)
+                        != Coalesce(
+                            fifo_expiration_date, datetime.date.min)))))
+        ids = [i for i, in cursor]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                    [table.fifo_date, table.fifo_expiration_date],
+                    [fifo_date, fifo_expiration_date],
+                    where=reduce_ids(table.id, sub_ids)))
+        if ids and get_option('quantity_index', False):
+            LotFifoQuantity.update_fifo_dates(cls.browse(ids))
+        return len(ids)
 
     def sort_quantities_fifo(self):
         if getattr(self, 'shelf_life_expiration_date', None):
@@ -14,3 +173,474 @@ class Lot(metaclass=PoolMeta):
         if getattr(self, 'lot_date', None):
             return self.lot_date
         return self.create_date.date()
+
+    def fifo_date_source(self):
+        "Return the name of the field from which comes the FIFO date"
+        for name in self._fifo_date_fields + ['create_date']:
+            value = getattr(self, name, None)
+            if value:
+                if isinstance(value, datetime.datetime):
+                    value = value.date()
+                return name if value == self.fifo_date else 'fifo_date'
+        return 'fifo_date'
+
+    def fifo_key_source(self, strategy=None):
+        "Return the name of the field from which comes the key of strategy"
+        if strategy == 'receipt':
+            return 'receipt_date' if self.receipt_date else 'create_date'
+        if strategy in {'lot_date', 'lifo'}:
+            if getattr(self, 'lot_date', None):
+                return 'lot_date'
+            return 'create_date'
+        return self.fifo_date_source()
+
+    def fifo_expiration(self):
+        for name in self._fifo_expiration_date_fields:
+            if getattr(self, name, None):
+                return getattr(self, name)
+
+    def compute_fields(self, field_names=None):
+        values = super().compute_fields(field_names=field_names)
+        if (field_names is None
+                or not field_names.isdisjoint(self._fifo_date_fields)):
+            fifo_date = self.sort_quantities_fifo()
+            if getattr(self, 'fifo_date', None) != fifo_date:
+                values['fifo_date'] = fifo_date
+            fifo_expiration_date = self.fifo_expiration()
+            if (getattr(self, 'fifo_expiration_date', None)
+                    != fifo_expiration_date):
+                values['fifo_expiration_date'] = fifo_expiration_date
+        return values
+
+    @classmethod
+    def on_modification(cls, mode, lots, field_names=None):
+        super().on_modification(mode, lots, field_names=field_names)
+        if mode == 'delete' or (mode == 'write'
+                and (field_names is None
+                    or not field_names.isdisjoint(
+                        {'fifo_date', 'fifo_expiration_date'}
+                        | set(cls._fifo_date_fields)))):
+            cls._fifo_date_cache.clear()
+            if mode == 'write' and get_option('quantity_index', False):
+                LotFifoQuantity = Pool().get('stock.lot.fifo.quantity')
+                LotFifoQuantity.update_fifo_dates(lots)
+
+    @classmethod
+    def get_fifo_dates(cls, lot_ids):
+        "Return a dictionary with the FIFO date of each lot id"
+        return {i: v[0] for i, v in cls._get_fifo_values(lot_ids).items()}
+
+    @classmethod
+    def get_fifo_keys(cls, lot_ids, strategy=None):
+        """Return a dictionary with the FIFO key of each lot id
+
+        The keys are integers which sort the lots in the order of the strategy
+        and the lots without date last.
+        """
+        default = datetime.date.max.toordinal()
+        if strategy in {None, 'fefo'}:
+            return {i: d.toordinal() if d else default
+                for i, d in cls.get_fifo_dates(lot_ids).items()}
+
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        keys, missing = {}, []
+        for lot_id in lot_ids:
+            key = cls._fifo_date_cache.get((strategy, lot_id))
+            if key is None:
+                missing.append(lot_id)
+            else:
+                keys[lot_id] = key
+        stats = get_stats()
+        stats.add('lots_queried', len(missing))
+        column, descending = cls._fifo_key_column(strategy, table)
+        for sub_ids in grouped_slice(missing):
+            stats.add('lot_queries')
+            cursor.execute(*table.select(
+                    table.id, column,
+                    where=reduce_ids(table.id, sub_ids)))
+            for lot_id, date in cursor:
+                if isinstance(date, str):
+                    date = datetime.date.fromisoformat(date)
+                if not date:
+                    key = default
+                elif descending:
+                    key = -date.toordinal()
+                else:
+                    key = date.toordinal()
+                keys[lot_id] = key
+                cls._fifo_date_cache.set((strategy, lot_id), key)
+        return keys
+
+    @classmethod
+    def _fifo_key_column(cls, strategy, table):
+        """Return the SQL expression of the date of the strategy and if it is
+        sorted descending"""
+        if strategy == 'receipt':
+            return cls.fifo_date.sql_cast(
+                Coalesce(table.receipt_date, table.create_date)), False
+        if strategy in {'lot_date', 'lifo'}:
+            if 'lot_date' in cls._fields:
+                column = Coalesce(table.lot_date, table.create_date)
+            else:
+                column = table.create_date
+            column = cls.fifo_date.sql_cast(column)
+            return column, strategy == 'lifo'
+        return table.fifo_date, False
+
+    @classmethod
+    def update_receipt_dates(cls, lots):
+        "Set the receipt date of the lots from their done moves"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        dates = defaultdict(list)
+        for sub_lots in grouped_slice(lots):
+            query = cls._receipt_date_query([l.id for l in sub_lots])
+            cursor.execute(*query)
+            for lot_id, date in cursor:
+                dates[date].append(lot_id)
+        updated = False
+        for date, lot_ids in dates.items():
+            for sub_ids in grouped_slice(lot_ids):
+                cursor.execute(*table.update(
+                        [table.receipt_date], [date],
+                        where=reduce_ids(table.id, sub_ids)
+                        & (Coalesce(table.receipt_date, datetime.date.min)
+                            != date)))
+                updated |= cursor.rowcount > 0
+        if updated:
+            cls._fifo_date_cache.clear()
+
+    @classmethod
+    def _receipt_date_query(cls, lot_ids=None):
+        """Return the query of the first effective date of the done moves
+        which received each lot in storage"""
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+
+        where = ((move.state == 'done')
+            & (move.lot != Null)
+            & (from_location.type != 'storage')
+            & (to_location.type == 'storage'))
+        if lot_ids is not None:
+            where &= reduce_ids(move.lot, lot_ids)
+        return (move
+            .join(from_location,
+                condition=move.from_location == from_location.id)
+            .join(to_location,
+                condition=move.to_location == to_location.id)
+            .select(
+                move.lot.as_('lot'),
+                Min(move.effective_date).as_('receipt_date'),
+                where=where,
+                group_by=[move.lot]))
+
+    @classmethod
+    def get_fifo_skipped(cls, lot_ids):
+        "Return the set of lot ids which must not be assigned"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        if not get_option('exclude_expired', False):
+            return set()
+        cutoff = Date.today() + datetime.timedelta(
+            days=get_option('expiration_cutoff', 0))
+        return {i for i, (_, expiration) in cls._get_fifo_values(
+                lot_ids).items()
+            if expiration and expiration < cutoff}
+
+    @classmethod
+    def _get_fifo_values(cls, lot_ids):
+        "Return a dictionary with the FIFO and expiration dates of each lot"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        values, missing = {}, []
+        for lot_id in lot_ids:
+            value = cls._fifo_date_cache.get(lot_id)
+            if value is None:
+                missing.append(lot_id)
+            else:
+                values[lot_id] = tuple(value)
+        stats = get_stats()
+        stats.add('lots_queried', len(missing))
+        for sub_ids in grouped_slice(missing):
+            stats.add('lot_queries')
+            cursor.execute(*table.select(
+                    table.id, table.fifo_date, table.fifo_expiration_date,
+                    where=reduce_ids(table.id, sub_ids)))
+            for lot_id, date, expiration in cursor:
+                values[lot_id] = (date, expiration)
+                cls._fifo_date_cache.set(lot_id, [date, expiration])
+        return values
+
+
+class LotFifoQuantity(ModelSQL):
+    "Lot FIFO Quantity"
+    __name__ = 'stock.lot.fifo.quantity'
+    company = fields.Many2One(
+        'company.company', "Company", required=True, ondelete='CASCADE')
+    location = fields.Many2One(
+        'stock.location', "Location", required=True, ondelete='CASCADE')
+    product = fields.Many2One(
+        'product.product', "Product", required=True, ondelete='CASCADE',
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    lot = fields.Many2One('stock.lot', "Lot", ondelete='CASCADE')
+    quantity = fields.Float("Quantity", required=True,
+        help="The quantity in the default unit of the product.")
+    fifo_date = fields.Date("FIFO Date")
+    # The columns of the key without the lot
+    _key_columns = ['company', 'location', 'product']
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        key = [Column(t, c) for c in cls._key_columns]
+        cls._sql_constraints += [
+            ('key_lot_unique', Unique(t, *key, t.lot),
+                'stock_lot_fifo.msg_lot_fifo_quantity_key_unique'),
+            # The lot may be NULL which is distinct for Unique
+            ('key_unique', Exclude(t, *((c, Equal) for c in key),
+                    where=t.lot == Null),
+                'stock_lot_fifo.msg_lot_fifo_quantity_key_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.company, Index.Range()),
+                (t.product, Index.Range()),
+                (t.location, Index.Range()),
+                (t.lot, Index.Range())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        duplicate = cls.__table__()
+        table_h = cls.__table_handler__(module_name)
+
+        if table_h.column_exist('quantity'):
+            # Merge the duplicated keys before adding the unique constraints
+            key = [Column(table, c) for c in cls._key_columns] + [
+                Coalesce(table.lot, -1)]
+            duplicate_key = [
+                Column(duplicate, c) for c in cls._key_columns] + [
+                Coalesce(duplicate.lot, -1)]
+            same_key = None
+            for column, duplicate_column in zip(key, duplicate_key):
+                condition = column == duplicate_column
+                same_key = (
+                    condition if same_key is None else same_key & condition)
+            cursor.execute(*table.update(
+                    [table.quantity],
+                    [duplicate.select(
+                            Sum(duplicate.quantity), where=same_key)],
+                    where=table.id.in_(table.select(Min(table.id),
+                            group_by=key,
+                            having=Count(Literal('*')) > 1))))
+            cursor.execute(*table.delete(
+                    where=~table.id.in_(table.select(Min(table.id),
+                            group_by=key))))
+
+        super().__register__(module_name)
+
+    @classmethod
+    def add_quantities(cls, quantities):
+        """Add the quantities to the index
+
+        quantities is a dictionary with (company, location, product, lot) as
+        key and the quantity to add as value.
+        The keys are inserted or updated with ON CONFLICT so concurrent
+        transactions can not duplicate them.
+        """
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        quantities = {k: q for k, q in quantities.items() if q}
+        if not quantities:
+            return
+        if not database.has_insert_on_conflict():
+            cls._add_quantities_update(quantities)
+            return
+        lot2date = Lot.get_fifo_dates({k[3] for k in quantities} - {None})
+        key = [Column(table, c) for c in cls._key_columns]
+        columns = key + [table.lot, table.quantity, table.fifo_date,
+            table.create_uid, table.create_date]
+
+        def values(keys, quantity=None):
+            return [list(k) + [
+                    quantities[k] if quantity is None else quantity,
+                    lot2date.get(k[3]), transaction.user, CurrentTimestamp()]
+                for k in keys]
+
+        lot_keys = [k for k in quantities if k[3] is not None]
+        for keys in grouped_slice(lot_keys):
+            cursor.execute(*table.insert(columns, values(keys),
+                    on_conflict=Conflict(table,
+                        indexed_columns=key + [table.lot],
+                        columns=[
+                            table.quantity, table.write_uid, table.write_date],
+                        values=[
+                            table.quantity + Excluded.quantity,
+                            Excluded.create_uid, Excluded.create_date])))
+
+        # The key without lot is not unique for ON CONFLICT DO UPDATE so the
+        # missing rows are inserted before they are updated
+        no_lot_keys = [k for k in quantities if k[3] is None]
+        for keys in grouped_slice(no_lot_keys):
+            cursor.execute(*table.insert(columns, values(keys, 0),
+                    on_conflict=Conflict(table)))
+        if no_lot_keys:
+            cls._add_quantities_update(
+                {k: quantities[k] for k in no_lot_keys})
+
+    @classmethod
+    def _add_quantities_update(cls, quantities):
+        "Add the quantities by update or insert without upsert support"
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        to_insert = []
+        for key, quantity in quantities.items():
+            *values, lot = key
+            where = Coalesce(table.lot, -1) == (lot if lot is not None else -1)
+            for column, value in zip(cls._key_columns, values):
+                where &= Column(table, column) == value
+            cursor.execute(*table.update(
+                    [table.quantity, table.write_uid, table.write_date],
+                    [table.quantity + quantity, transaction.user,
+                        CurrentTimestamp()],
+                    where=where))
+            if not cursor.rowcount:
+                to_insert.append(key)
+        if to_insert:
+            lot2date = Lot.get_fifo_dates({k[3] for k in to_insert} - {None})
+            cursor.execute(*table.insert(
+                    [Column(table, c) for c in cls._key_columns] + [
+                        table.lot, table.quantity, table.fifo_date,
+                        table.create_uid, table.create_date],
+                    [list(key) + [quantities[key], lot2date.get(key[3]),
+                            transaction.user, CurrentTimestamp()]
+                        for key in to_insert]))
+
+    @classmethod
+    def lock_quantities(cls, company_ids, location_ids, product_ids):
+        "Lock the quantities of the products at the locations"
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        count = database.IN_MAX // 2
+        for sub_location_ids in grouped_slice(location_ids, count):
+            cursor.execute(*table.select(Literal(1),
+                    where=reduce_ids(table.location, list(sub_location_ids))
+                    & reduce_ids(table.product, product_ids)
+                    & table.company.in_(company_ids),
+                    for_=For('UPDATE', nowait=True)))
+
+    @classmethod
+    def update_fifo_dates(cls, lots):
+        "Copy the FIFO date of the lots to the index"
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        lot = Lot.__table__()
+
+        for sub_lots in grouped_slice(lots):
+            cursor.execute(*table.update(
+                    [table.fifo_date],
+                    [lot.select(lot.fifo_date,
+                            where=lot.id == table.lot)],
+                    where=reduce_ids(table.lot, [l.id for l in sub_lots])))
+
+    @classmethod
+    def get_quantities(cls, company, location_ids, product_ids):
+        """Return the quantities by (location, product, lot) in FIFO order
+
+        The result has the same keys as Product.products_by_location with
+        ('product', 'lot') as grouping.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        quantities = {}
+        if not location_ids or not product_ids:
+            return quantities
+        from_ = table
+        group_by = [
+            table.location, table.product, table.lot, table.fifo_date]
+        order_by = [Coalesce(table.fifo_date, datetime.date.max).asc]
+        if get_option('location_rank', False):
+            location = Location.__table__()
+            from_ = table.join(location,
+                condition=table.location == location.id)
+            group_by.append(location.left)
+            order_by.append(location.left.asc)
+        order_by += [table.lot.asc, table.location.asc]
+        cursor.execute(*from_.select(
+                table.location, table.product, table.lot,
+                Sum(table.quantity),
+                where=(table.company == company)
+                & reduce_ids(table.location, location_ids)
+                & reduce_ids(table.product, product_ids),
+                group_by=group_by,
+                order_by=order_by))
+        for location, product, lot, quantity in cursor:
+            if quantity:
+                quantities[(location, product, lot)] = quantity
+        get_stats().add('index_quantities', len(quantities))
+        return quantities
+
+    @classmethod
+    def rebuild(cls):
+        "Rebuild the index from the moves"
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        move = Move.__table__()
+        lot = Lot.__table__()
+
+        incoming = move.select(
+            move.company, move.to_location.as_('location'), move.product,
+            move.lot, move.internal_quantity.as_('quantity'),
+            where=move.state == 'done')
+        outgoing = move.select(
+            move.company, move.from_location.as_('location'), move.product,
+            move.lot, (-move.internal_quantity).as_('quantity'),
+            where=move.state.in_(['done', 'assigned']))
+        union = Union(incoming, outgoing, all_=True)
+        keys = [union.company, union.location, union.product, union.lot]
+        query = union.join(lot, 'LEFT', condition=union.lot == lot.id
+            ).select(*keys,
+                Sum(union.quantity), lot.fifo_date,
+                Literal(transaction.user), CurrentTimestamp(),
+                group_by=keys + [lot.fifo_date],
+                having=Sum(union.quantity) != 0)
+
+        cursor.execute(*table.delete())
+        cursor.execute(*table.insert(
+                [table.company, table.location, table.product, table.lot,
+                    table.quantity, table.fifo_date,
+                    table.create_uid, table.create_date],
+                query))
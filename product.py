@@ -0,0 +1,22 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import PoolMeta
+
+from .lot import FIFO_STRATEGIES
+
+
+class Category(metaclass=PoolMeta):
+    __name__ = 'product.category'
+    fifo_strategy = fields.Selection(FIFO_STRATEGIES, "FIFO Strategy",
+        help="The order in which the lots of the products are assigned.\n"
+        "Leave empty to use the strategy of the parent category or of the "
+        "warehouse.")
+
+    def get_fifo_strategy(self):
+        "Return the FIFO strategy of the category or of its parents"
+        category = self
+        while category:
+            if category.fifo_strategy:
+                return category.fifo_strategy
+            category = category.parent
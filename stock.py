@@ -1,33 +1,646 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import datetime
+import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from copy import copy
+from itertools import chain, tee
+from weakref import WeakKeyDictionary
+
+from sql import Column
+from sql.conditionals import Coalesce
+
+from trytond.model import ModelView
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .tools import (
+    add_trace, collect_stats, get_option, get_stats, iter_sorted)
+
+logger = logging.getLogger(__name__)
+
+# The quantities of the moves being modified which are in the FIFO index
+# with the number of nested modifications by transaction
+_fifo_quantities = WeakKeyDictionary()
+# The FIFO order of the quantities by product and locations shared by the
+# moves of assign_try by transaction
+_fifo_orders = WeakKeyDictionary()
+# The quantities sorted for the moves to trace until they are picked by
+# transaction
+_fifo_traces = WeakKeyDictionary()
+
+
+# The FIFO strategy by product and location resolved for the moves of
+# assign_try by transaction
+_fifo_strategies = WeakKeyDictionary()
+
+
+@contextmanager
+def _share(shared, enabled=True):
+    "Share the values stored in shared for the transaction"
+    transaction = Transaction()
+    if transaction in shared or not enabled:
+        yield
+        return
+    shared[transaction] = {}
+    try:
+        yield
+    finally:
+        del shared[transaction]
+
+
+def _share_fifo_orders(enabled=True):
+    "Share the FIFO order of the quantities between the moves"
+    return _share(_fifo_orders, enabled)
+
+
+def _share_fifo_strategies():
+    "Resolve the FIFO strategy once by product and location for the moves"
+    return _share(_fifo_strategies)
 
 
 class Move(metaclass=PoolMeta):
     __name__ = 'stock.move'
+    # Fields which change the quantities of the FIFO index
+    _fifo_quantity_fields = {
+        'company', 'from_location', 'to_location', 'product', 'lot', 'state',
+        'internal_quantity'}
+    # Fields which change the receipt date of the lots
+    _fifo_receipt_fields = {
+        'from_location', 'to_location', 'lot', 'state', 'effective_date'}
 
     @classmethod
     def assign_try(cls, moves, with_childs=True, grouping=('product',),
             pblc=None):
-        if 'lot' not in grouping:
-            moves_with_lot, moves_without_lot = [], []
+        context = {}
+        if pblc is None:
+            context = cls._assign_try_context()
+        with Transaction().set_context(**context), \
+                collect_stats(get_option('stats', False)) as stats, \
+                _share_fifo_orders(get_option('group_sort', True)), \
+                _share_fifo_strategies():
+            if 'lot' not in grouping:
+                with stats.timer('split'):
+                    moves_with_lot, moves_without_lot = (
+                        cls._assign_try_split_lot(moves))
+                stats.add('moves_with_lot', len(moves_with_lot))
+                stats.add('moves_without_lot', len(moves_without_lot))
+                lot_grouping = grouping + ('lot',)
+                lot_pblc = pblc
+                if pblc is None and (
+                        (moves_with_lot and moves_without_lot)
+                        or ((moves_with_lot or moves_without_lot)
+                            and cls._assign_try_fifo_quantities(
+                                lot_grouping))):
+                    # Compute the quantities once for both kind of moves
+                    with stats.timer('products_by_location'):
+                        lot_pblc = cls._assign_try_products_by_location(
+                            moves_with_lot + moves_without_lot, with_childs,
+                            lot_grouping)
+                with stats.timer('assign_with_lot'):
+                    success = super().assign_try(
+                        moves_with_lot, with_childs=with_childs,
+                        grouping=lot_grouping, pblc=lot_pblc)
+                if pblc is None and lot_pblc is not None:
+                    pblc = {
+                        c: cls._assign_try_ungroup_lot(pbl, lot_grouping)
+                        for c, pbl in lot_pblc.items()}
+                with stats.timer('assign_without_lot'):
+                    success &= super().assign_try(
+                        moves_without_lot, with_childs=with_childs,
+                        grouping=grouping, pblc=pblc)
+            else:
+                stats.add('moves_with_lot', len(moves))
+                if pblc is None and cls._assign_try_fifo_quantities(grouping):
+                    with stats.timer('products_by_location'):
+                        pblc = cls._assign_try_products_by_location(
+                            moves, with_childs, grouping)
+                with stats.timer('assign_with_lot'):
+                    success = super().assign_try(
+                        moves, with_childs=with_childs, grouping=grouping,
+                        pblc=pblc)
+        return success
+
+    @classmethod
+    def assign_try_lots(cls, moves=None):
+        """
+        Assign in background the draft moves which require a lot.
+        The moves are grouped by warehouse and product in chunks which are
+        assigned in order by successive queue tasks.
+        """
+        if moves is None:
+            moves = cls.search([
+                    ('state', '=', 'draft'),
+                    ('from_location.type', '=', 'storage'),
+                    ('lot', '=', None),
+                    cls._assign_try_lots_domain(),
+                    ], order=[
+                    ('planned_date', 'ASC NULLS LAST'),
+                    ('id', 'ASC'),
+                    ])
+        moves = [m for m in moves if m.state == 'draft']
+        moves, _ = cls._assign_try_split_lot(moves)
+        chains = cls._assign_try_lots_chunks(
+            moves, get_option('assign_chunk', 100))
+        logger.info(
+            "assigning %d moves in %d chunks",
+            len(moves), sum(map(len, chains)))
+        for chunk, *chunks in chains:
+            cls.__queue__.assign_try_chunks(cls.browse(chunk), chunks)
+
+    @classmethod
+    def _assign_try_lots_domain(cls):
+        "Return the domain of the documents of the moves to assign"
+        domain = ['OR'] + [
+            ('shipment.state', '=', 'waiting', model)
+            for model in cls._get_shipment()]
+        if 'production_input' in cls._fields:
+            domain.append(('production_input.state', '=', 'waiting'))
+        return domain
+
+    @classmethod
+    def _assign_try_lots_chunks(cls, moves, size):
+        """
+        Return the lists of chunks of move ids to assign in order
+        by warehouse and product.
+        The groups which fit in a chunk are assigned together.
+        """
+        groups = defaultdict(list)
+        for move in moves:
+            warehouse = move.from_location.warehouse
+            key = (warehouse.id if warehouse else None, move.product.id)
+            groups[key].append(move.id)
+        chains, chunk = [], []
+        for ids in groups.values():
+            if len(ids) > size:
+                chains.append(
+                    [ids[i:i + size] for i in range(0, len(ids), size)])
+                continue
+            if len(chunk) + len(ids) > size:
+                chains.append([chunk])
+                chunk = []
+            chunk = chunk + ids
+        if chunk:
+            chains.append([chunk])
+        return chains
+
+    @classmethod
+    def assign_try_chunks(cls, moves, chunks):
+        "Assign the moves and queue the assignment of the next chunks"
+        success = cls.assign_try(moves)
+        logger.info(
+            "assigned chunk of %d moves %s, %d chunks remaining",
+            len(moves), "completely" if success else "partially",
+            len(chunks))
+        cls._assign_try_lots_documents(cls.browse(moves))
+        if chunks:
+            chunk, *chunks = chunks
+            cls.__queue__.assign_try_chunks(cls.browse(chunk), chunks)
+
+    @classmethod
+    def _assign_try_lots_documents(cls, moves):
+        """
+        Assign the waiting shipments and productions of the moves
+        when all their moves to assign are assigned.
+        """
+        documents = defaultdict(set)
+        for move in moves:
+            shipment = move.shipment
+            if shipment and shipment.state == 'waiting':
+                documents[shipment.__class__, 'assign_moves'].add(shipment)
+            production = getattr(move, 'production_input', None)
+            if production and production.state == 'waiting':
+                documents[production.__class__, 'inputs'].add(production)
+        for (Document, field), records in documents.items():
+            to_assign = [
+                r for r in records
+                if all(m.state not in {'staging', 'draft'}
+                    for m in getattr(r, field) if m.assignation_required)]
+            if to_assign:
+                Document.assign(to_assign)
+
+    @classmethod
+    def _assign_try_context(cls):
+        "Return the context to assign with quantities computed by the module"
+        context = {}
+        if (get_option('sql_order', False)
+                or get_option('quantity_index', False)):
+            # Quantities computed by products_by_location or read from the
+            # index are in FIFO order
+            context['_stock_lot_fifo_ordered'] = True
+        return context
+
+    @classmethod
+    def plan_assign(cls, moves, with_childs=True, grouping=('product',)):
+        """
+        Return the lots and locations that assign_try would pick for the moves
+        as a list of (move, lot, location, quantity) in the unit of the move.
+        The quantities are computed once for all the moves and nothing is
+        locked nor written.
+        """
+        # Browse the moves together to prefetch them
+        moves = [m for m in cls.browse(moves) if m.state == 'draft']
+        if not moves:
+            return []
+        if 'lot' in grouping:
+            lot_grouping = grouping
+            moves_with_lot, moves_without_lot = moves, []
+        else:
+            lot_grouping = grouping + ('lot',)
+            moves_with_lot, moves_without_lot = (
+                cls._assign_try_split_lot(moves))
+        with Transaction().set_context(**cls._assign_try_context()), \
+                _share_fifo_orders(get_option('group_sort', True)), \
+                _share_fifo_strategies():
+            pblc = cls._assign_try_products_by_location(
+                moves, with_childs, lot_grouping, lock=False)
+            child_locations = {}
+            plan = cls._plan_assign(
+                moves_with_lot, with_childs, lot_grouping, pblc,
+                child_locations)
+            if moves_without_lot:
+                pblc = {
+                    c: cls._assign_try_ungroup_lot(pbl, lot_grouping)
+                    for c, pbl in pblc.items()}
+                plan += cls._plan_assign(
+                    moves_without_lot, with_childs, grouping, pblc,
+                    child_locations)
+        return plan
+
+    @classmethod
+    def _plan_assign(
+            cls, moves, with_childs, grouping, pblc, child_locations):
+        "Pick the moves in order from pblc like assign_try"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Uom = pool.get('product.uom')
+
+        plan = []
+        for move in moves:
+            pbl = pblc[move.company.id]
+            if with_childs:
+                childs = child_locations.get(move.from_location)
+                if childs is None:
+                    childs = Location.search([
+                            ('parent', 'child_of', [move.from_location.id]),
+                            ('type', '!=', 'view'),
+                            ])
+                    child_locations[move.from_location] = childs
+                childs = list(childs)
+            else:
+                childs = [move.from_location]
+            # Prevent picking from the destination location
+            if move.to_location in childs:
+                childs.remove(move.to_location)
+            # Try first to pick from source location
+            if move.from_location in childs:
+                childs.remove(move.from_location)
+                childs.insert(0, move.from_location)
+
+            pattern = []
+            for field in grouping:
+                value = getattr(move, field)
+                pattern.append(getattr(value, 'id', value))
+            location_qties = []
+            for key, qty in pbl.items():
+                if all(p is None or k == p
+                        for k, p in zip(key[1:], pattern)):
+                    qty = Uom.compute_qty(
+                        move.product.default_uom, qty, move.unit,
+                        round=False)
+                    location_qties.append((key, qty))
+            location_qties = move.sort_quantities(
+                location_qties, childs, grouping)
+
+            for key, qty in move.pick_product(location_qties):
+                values = dict(zip(grouping, key[1:]))
+                lot = Lot(values['lot']) if values.get('lot') else None
+                plan.append((move, lot, Location(key[0]), qty))
+                pbl[key] = pbl.get(key, 0.0) - Uom.compute_qty(
+                    move.unit, qty, move.product.default_uom, round=False)
+        return plan
+
+    @classmethod
+    def _assign_try_split_lot(cls, moves):
+        "Split the moves between those to assign with and without lot"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+
+        # Browse all the moves, products and locations at once to prefetch
+        # them even if the moves are not instantiated together
+        moves = cls.browse(moves)
+        keys = {
+            m.id: (m.product.id, m.from_location.id, m.to_location.id)
+            for m in moves if not m.lot}
+        products = Product.browse(list({k[0] for k in keys.values()}))
+        products = {p.id: p for p in products}
+        locations = Location.browse(
+            list({l for k in keys.values() for l in k[1:]}))
+        locations = {l.id: l for l in locations}
+
+        moves_with_lot, moves_without_lot = [], []
+        lot_required = {}
+        for move in moves:
+            key = keys.get(move.id)
+            if key and key not in lot_required:
+                product_id, from_id, to_id = key
+                lot_required[key] = products[product_id].lot_is_required(
+                    locations[from_id], locations[to_id])
+            if not key or lot_required[key]:
+                moves_with_lot.append(move)
+            else:
+                moves_without_lot.append(move)
+        return moves_with_lot, moves_without_lot
+
+    @classmethod
+    def _assign_try_products_by_location(
+            cls, moves, with_childs, grouping, lock=True):
+        """
+        Lock and compute the quantities by location and company like
+        assign_try does when no pblc is provided.
+        The quantities are read from the FIFO index when it is used.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+        Product = pool.get('product.product')
+
+        moves = [m for m in moves if m.state in {'draft', 'staging'}]
+        if with_childs:
+            locations = Location.search([
+                    ('parent', 'child_of',
+                        [m.from_location.id for m in moves]),
+                    ])
+        else:
+            locations = list({m.from_location for m in moves})
+        location_ids = [l.id for l in locations]
+        product_ids = list({m.product.id for m in moves})
+
+        pblc = {}
+        for company in {m.company for m in moves}:
+            with Transaction().set_context(company=company.id):
+                stock_date_end = Date.today()
+            if lock:
+                cls._assign_try_lock(
+                    product_ids, location_ids, [company.id], stock_date_end,
+                    grouping)
+            if cls._assign_try_fifo_quantities(grouping):
+                pblc[company.id] = LotFifoQuantity.get_quantities(
+                    company.id, location_ids, product_ids)
+                continue
+            with Transaction().set_context(
+                    stock_date_end=stock_date_end,
+                    stock_assign=True,
+                    company=company.id):
+                pblc[company.id] = Product.products_by_location(
+                    location_ids,
+                    grouping=grouping,
+                    grouping_filter=(product_ids,))
+        return pblc
+
+    @classmethod
+    def _assign_try_lock(
+            cls, product_ids, location_ids, company_ids, date, grouping):
+        pool = Pool()
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+        if (get_option('quantity_index', False)
+                and get_option('lock_index', False)
+                and Transaction().database.has_select_for()):
+            # Only the quantities of the products at the locations must not
+            # change until the end of the transaction
+            LotFifoQuantity.lock_quantities(
+                company_ids, location_ids, product_ids)
+        else:
+            super()._assign_try_lock(
+                product_ids, location_ids, company_ids, date, grouping)
+
+    @classmethod
+    def _assign_try_fifo_quantities(cls, grouping):
+        "Return if the quantities are read from the FIFO index"
+        return (grouping == ('product', 'lot')
+            and get_option('quantity_index', False))
+
+    @classmethod
+    def _assign_try_ungroup_lot(cls, pbl, grouping):
+        "Return the quantities of pbl summed over the lots"
+        lot_idx = grouping.index('lot') + 1
+        quantities = {}
+        for key, quantity in pbl.items():
+            if len(key) != len(grouping) + 1:
+                continue
+            key = key[:lot_idx] + key[lot_idx + 1:]
+            quantities[key] = quantities.get(key, 0.0) + quantity
+        return quantities
+
+    @classmethod
+    def check_modification(cls, mode, moves, values=None, external=False):
+        super().check_modification(
+            mode, moves, values=values, external=external)
+        if mode == 'create' and get_option('quantity_index', False):
+            # The new moves are not yet in the index
+            cls._fifo_quantity_begin([m.id for m in moves], created=True)
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        super().on_modification(mode, moves, field_names=field_names)
+        if mode == 'create':
+            if get_option('quantity_index', False):
+                cls._fifo_quantity_end([m.id for m in moves])
+            cls._fifo_update_receipt_dates([m.id for m in moves])
+
+    @classmethod
+    def on_write(cls, moves, values):
+        callback = super().on_write(moves, values)
+        if (get_option('quantity_index', False)
+                and not cls._fifo_quantity_fields.isdisjoint(values)):
+            ids = [m.id for m in moves]
+            cls._fifo_quantity_begin(ids)
+            callback.append(lambda: cls._fifo_quantity_end(ids))
+        if (values.get('state') == 'done'
+                or (not cls._fifo_receipt_fields.isdisjoint(values)
+                    and any(m.state == 'done' for m in moves))):
+            ids = [m.id for m in moves]
+            callback.append(lambda: cls._fifo_update_receipt_dates(ids))
+        return callback
+
+    @classmethod
+    def _fifo_update_receipt_dates(cls, ids):
+        "Update the receipt date of the lots of the done incoming moves"
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        lots = {m.lot for m in cls.browse(ids)
+            if m.lot and m.state == 'done'
+            and m.from_location.type != 'storage'
+            and m.to_location.type == 'storage'}
+        if lots:
+            Lot.update_receipt_dates(list(lots))
+
+    @classmethod
+    @ModelView.button
+    def do(cls, moves):
+        super().do(moves)
+        if get_option('prewarm', False):
+            cls._fifo_queue_prewarm(moves)
+
+    @classmethod
+    def _fifo_queue_prewarm(cls, moves):
+        "Queue the prewarm of the FIFO data of the lots received by the moves"
+        moves = [m for m in moves
+            if m.lot
+            and m.from_location.type != 'storage'
+            and m.to_location.type == 'storage']
+        if moves:
+            cls.__queue__.prewarm_fifo(moves)
+
+    @classmethod
+    def prewarm_fifo(cls, moves):
+        """
+        Load the FIFO data of the lots received by the moves.
+
+        The FIFO keys and the location ranks are kept in the memory caches of
+        the worker process, so only the assignments run later by this process
+        (like assign_try_chunks) reuse them.
+        The availability of the received products is read like an assignment
+        from the receiving locations would, which loads its rows in the
+        database buffers shared by all the processes.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+
+        location_rank = get_option('location_rank', False)
+        strategies = {'fefo'}
+        with _share_fifo_strategies():
             for move in moves:
-                if (move.lot or move.product.lot_is_required(
-                        move.from_location, move.to_location)):
-                    moves_with_lot.append(move)
-                else:
-                    moves_without_lot.append(move)
-            success = super().assign_try(
-                moves_with_lot, with_childs=with_childs,
-                grouping=grouping + ('lot',), pblc=pblc)
-            success &= super().assign_try(
-                moves_without_lot, with_childs=with_childs,
-                grouping=grouping, pblc=pblc)
+                # The lots are assigned from the location which received them
+                strategies.add(cls(
+                        product=move.product,
+                        from_location=move.to_location).get_fifo_strategy())
+                if location_rank:
+                    Location.get_fifo_ranks(move.to_location.id)
+        lot_ids = {m.lot.id for m in moves}
+        for strategy in strategies:
+            Lot.get_fifo_keys(lot_ids, strategy)
+        drafts = [
+            cls(product=m.product, from_location=m.to_location,
+                company=m.company, state='draft')
+            for m in moves]
+        with Transaction().set_context(**cls._assign_try_context()), \
+                get_stats().timer('products_by_location'):
+            cls._assign_try_products_by_location(
+                drafts, False, ('product', 'lot'), lock=False)
+        logger.info(
+            "prewarmed FIFO data of %d lots for %d strategies "
+            "and %d locations and products",
+            len(lot_ids), len(strategies),
+            len({(m.to_location, m.product) for m in moves}))
+
+    @classmethod
+    def on_delete(cls, moves):
+        callback = super().on_delete(moves)
+        if get_option('quantity_index', False):
+            ids = [m.id for m in moves]
+            cls._fifo_quantity_begin(ids)
+            callback.append(lambda: cls._fifo_quantity_end(ids))
+        return callback
+
+    @classmethod
+    def _fifo_quantity_begin(cls, ids, created=False):
+        "Store the quantities of the moves in the index before modification"
+        pending = _fifo_quantities.setdefault(Transaction(), {})
+        new_ids = [i for i in ids if i not in pending]
+        if created:
+            quantities = {}
         else:
-            success = super().assign_try(
-                moves, with_childs=with_childs, grouping=grouping, pblc=pblc)
-        return success
+            quantities = cls._fifo_quantities(new_ids)
+        for id_ in new_ids:
+            pending[id_] = [quantities.get(id_, {}), 0]
+        for id_ in ids:
+            pending[id_][1] += 1
+
+    @classmethod
+    def _fifo_quantity_end(cls, ids):
+        "Update the index with the quantities of the moves after modification"
+        pool = Pool()
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+        pending = _fifo_quantities[Transaction()]
+        quantities = cls._fifo_quantities(ids)
+        deltas = defaultdict(float)
+        for id_ in ids:
+            old, count = pending[id_]
+            new = quantities.get(id_, {})
+            for key, quantity in old.items():
+                deltas[key] -= quantity
+            for key, quantity in new.items():
+                deltas[key] += quantity
+            if count > 1:
+                pending[id_] = [new, count - 1]
+            else:
+                del pending[id_]
+        LotFifoQuantity.add_quantities(deltas)
+
+    @classmethod
+    def _fifo_quantities(cls, ids):
+        """
+        Return the quantities added to the FIFO index by each move id
+        as dictionary of (company, location, product, lot) and quantity
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        result = {}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(
+                    table.id, table.company, table.from_location,
+                    table.to_location, table.product, table.lot, table.state,
+                    table.internal_quantity,
+                    where=reduce_ids(table.id, sub_ids)))
+            for (id_, company, from_location, to_location, product, lot,
+                    state, quantity) in cursor:
+                quantities = result[id_] = defaultdict(float)
+                if state == 'done':
+                    quantities[(company, to_location, product, lot)] += (
+                        quantity or 0)
+                if state in {'done', 'assigned'}:
+                    quantities[(company, from_location, product, lot)] -= (
+                        quantity or 0)
+        return result
+
+    @classmethod
+    def compute_quantities_query(cls, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+
+        query = super().compute_quantities_query(
+            location_ids, with_childs=with_childs, grouping=grouping,
+            grouping_filter=grouping_filter)
+
+        if (query and 'lot' in grouping
+                and Transaction().context.get('_stock_lot_fifo_ordered')):
+            lot = Lot.__table__()
+            columns = ([Column(query, 'location').as_('location')]
+                + [Column(query, f).as_(f) for f in grouping]
+                + [Column(query, 'quantity').as_('quantity')])
+            from_ = query.join(lot, 'LEFT',
+                condition=Column(query, 'lot') == lot.id)
+            order_by = [Coalesce(lot.fifo_date, datetime.date.max).asc]
+            if get_option('location_rank', False):
+                # The rank of the locations follows their position in the tree
+                location = Location.__table__()
+                from_ = from_.join(location,
+                    condition=Column(query, 'location') == location.id)
+                order_by.append(location.left.asc)
+            order_by += [lot.id.asc, Column(query, 'location').asc]
+            query = from_.select(*columns, order_by=order_by)
+        return query
 
     def sort_quantities(self, quantities, locations, grouping):
         """
@@ -39,13 +652,98 @@ class Move(metaclass=PoolMeta):
         quantities[0][0] = (location.id, product.id, lot.id)
         quantities[0][0][0-2] = location.id/product.id/lot.id
         """
+        rate = get_option('trace_rate', 0.)
+        traced = 'lot' in grouping and rate and random.random() < rate
+        if traced:
+            start = time.perf_counter()
+        quantities, lot2key = self._sort_quantities_fifo(
+            quantities, locations, grouping)
+        window = get_option('packing_window', 0)
+        if 'lot' in grouping and window:
+            quantities = self._sort_quantities_packing(
+                quantities, grouping, window, lot2key)
+        if traced:
+            # pick_product completes the trace with the picked quantities
+            quantities = list(quantities)
+            _fifo_traces.setdefault(Transaction(), {})[self.id] = (
+                start, quantities, grouping, lot2key)
+        return quantities
+
+    def pick_product(self, quantities):
+        to_pick = super().pick_product(quantities)
+        trace = _fifo_traces.get(Transaction(), {}).pop(self.id, None)
+        if trace is not None:
+            self._add_fifo_trace(*trace, to_pick)
+        return to_pick
+
+    def _add_fifo_trace(self, start, quantities, grouping, lot2key, picked):
+        """Add the trace of the quantities sorted and picked for the move
+        with the FIFO key of the lots for the strategy"""
         pool = Pool()
         Lot = pool.get('stock.lot')
+        duration = time.perf_counter() - start
+        strategy = self.get_fifo_strategy()
+        lot_idx = grouping.index('lot') + 1
+        default = datetime.date.max.toordinal()
+        candidates = quantities[:get_option('trace_candidates', 50)]
+
+        def get_lot(key):
+            # The consumables are picked from a key with only the location
+            if len(key) != len(grouping) + 1:
+                return None
+            return key[lot_idx]
+        lots = {l.id: l for l in Lot.browse(
+                {get_lot(k) for k, _ in candidates} - {None})}
+
+        def candidate(key, quantity):
+            lot = lots.get(get_lot(key))
+            fifo_key = lot2key.get(get_lot(key), default)
+            return {
+                'location': int(key[0]),
+                'lot': get_lot(key),
+                'quantity': quantity,
+                'key': fifo_key,
+                'date': (datetime.date.fromordinal(abs(fifo_key))
+                    if fifo_key != default else None),
+                'source': lot.fifo_key_source(strategy) if lot else None,
+                }
+        add_trace({
+                'move': self.id,
+                'product': self.product.id,
+                'strategy': strategy,
+                'candidates': [candidate(k, q) for k, q in candidates],
+                'candidates_count': len(quantities),
+                'picked': [
+                    {'location': int(k[0]), 'lot': get_lot(k), 'quantity': q}
+                    for k, q in picked],
+                'time': duration,
+                })
+
+    def _sort_quantities_fifo(self, quantities, locations, grouping):
+        """Return the quantities sorted by FIFO and the FIFO key of the lots
+        for the strategy of the move"""
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+
+        strategy = self.get_fifo_strategy() if 'lot' in grouping else None
+        if (strategy == 'fefo'
+                and Transaction().context.get('_stock_lot_fifo_ordered')):
+            # The quantities are already sorted by the query
+            location_ids = {l.id for l in locations}
+            quantities = [q for q in quantities
+                if q[0][0] in location_ids and q[1] > 0]
+            lot_idx = grouping.index('lot') + 1
+            quantities, _ = self._sort_quantities_skip(quantities, lot_idx)
+            get_stats().add('quantities_presorted', len(quantities))
+            lot2key = Lot.get_fifo_keys(
+                {q[0][lot_idx] for q in quantities} - {None}, strategy)
+            return quantities, lot2key
 
         quantities = super().sort_quantities(quantities, locations, grouping)
 
         if 'lot' not in grouping:
-            return quantities
+            return quantities, {}
 
         # 'grouping' is a tuple of keys for sorting 'quantities'.
         # By default, 'quantities' contains the location as key, and the other
@@ -54,7 +752,128 @@ class Move(metaclass=PoolMeta):
         # another module adds an extra key to 'grouping', so getting its index
         # in 'grouping' + 1 because of location, prevents this error.
         lot_idx = grouping.index('lot') + 1
-        lots = Lot.search([('id', 'in', {q[0][lot_idx] for q in quantities})])
-        lot2date = {lot.id: lot.sort_quantities_fifo() for lot in lots}
-        return sorted(quantities,
-            key=lambda x: lot2date.get(x[0][lot_idx], datetime.datetime.max.date()))
+        # Only available quantities can be picked
+        quantities = [q for q in quantities if q[1] > 0]
+        stats = get_stats()
+
+        orders = _fifo_orders.get(Transaction())
+        if orders is not None:
+            # The lots keep the same order for the moves of the same product
+            # and locations, only their quantities change
+            order_key = (
+                self.product.id, tuple(l.id for l in locations), grouping,
+                strategy)
+            keys, order, lot2key = orders.get(order_key, (None, None, None))
+            if keys is not None and all(k in keys for k, _ in quantities):
+                stats.add('quantities_reused', len(quantities))
+                available = dict(quantities)
+                return ((k, available[k]) for k in copy(order)
+                    if k in available), lot2key
+
+        quantities, skipped = self._sort_quantities_skip(quantities, lot_idx)
+        with stats.timer('fifo_dates'):
+            lot2key = Lot.get_fifo_keys(
+                {q[0][lot_idx] for q in quantities} - {None}, strategy)
+        stats.add('lots', len(lot2key))
+        stats.add('quantities_sorted', len(quantities))
+        default = datetime.date.max.toordinal()
+
+        def fifo_date(quantity):
+            return lot2key.get(quantity[0][lot_idx], default)
+        if get_option('location_rank', False):
+            # Between lots of the same date, pick first the locations which
+            # are close in the tree of the warehouse
+            ranks = Location.get_fifo_ranks(self.from_location.id)
+            unranked = len(ranks)
+
+            def fifo_date(quantity, fifo_date=fifo_date):
+                # The rank is combined with the date in a single integer
+                return (fifo_date(quantity) * (unranked + 1)
+                    + ranks.get(quantity[0][0], unranked))
+        # pick_product consumes the quantities until the move is fulfilled
+        with stats.timer('sort'):
+            sorted_quantities = iter_sorted(quantities, key=fifo_date)
+        if orders is None:
+            return sorted_quantities, lot2key
+        # The next moves consume from the start the keys sorted lazily
+        order, = tee((k for k, _ in sorted_quantities), 1)
+        orders[order_key] = (
+            {k for k, _ in chain(quantities, skipped)}, order, lot2key)
+        available = dict(quantities)
+        return ((k, available[k]) for k in copy(order)), lot2key
+
+    def get_fifo_strategy(self):
+        """Return the FIFO strategy to assign the move
+
+        It is resolved once by product and location for the moves assigned
+        together.
+        """
+        strategies = _fifo_strategies.get(Transaction())
+        if strategies is None:
+            return self._get_fifo_strategy()
+        key = (self.product.id, self.from_location.id)
+        strategy = strategies.get(key)
+        if strategy is None:
+            strategy = strategies[key] = self._get_fifo_strategy()
+        return strategy
+
+    def _get_fifo_strategy(self):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        for category in self.product.categories_all:
+            strategy = category.get_fifo_strategy()
+            if strategy:
+                return strategy
+        warehouse = Location.get_fifo_warehouse(self.from_location.id)
+        if warehouse is not None and Location(warehouse).fifo_strategy:
+            return Location(warehouse).fifo_strategy
+        return get_option('strategy', 'fefo')
+
+    def _sort_quantities_skip(self, quantities, lot_idx):
+        """Return the quantities of the lots which can be assigned and the
+        others"""
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        skipped_lots = Lot.get_fifo_skipped(
+            {q[0][lot_idx] for q in quantities} - {None})
+        if not skipped_lots:
+            return quantities, []
+        usable, skipped = [], []
+        for quantity in quantities:
+            if quantity[0][lot_idx] in skipped_lots:
+                skipped.append(quantity)
+            else:
+                usable.append(quantity)
+        get_stats().add('quantities_skipped', len(skipped))
+        return usable, skipped
+
+    def _sort_quantities_packing(self, quantities, grouping, window, lot2key):
+        """
+        Put first the quantities which fulfill the move with the fewest picks
+        among the lots with a FIFO key within the window of days of the first
+        lot.
+        lot2key is the FIFO key of the lots for the strategy of the move.
+        """
+        lot_idx = grouping.index('lot') + 1
+        default = datetime.date.max.toordinal()
+        quantities = iter(quantities)
+        candidates, rest = [], []
+        limit = None
+        for quantity in quantities:
+            key = lot2key.get(quantity[0][lot_idx], default)
+            if limit is None:
+                limit = key + window
+            if key > limit:
+                rest.append(quantity)
+                break
+            candidates.append(quantity)
+
+        covering = [q for q in candidates if q[1] >= self.quantity]
+        if covering:
+            # The oldest lot which fulfills the move alone
+            candidates.remove(covering[0])
+            candidates.insert(0, covering[0])
+        else:
+            candidates.sort(key=lambda q: q[1], reverse=True)
+        get_stats().add('quantities_packed', len(candidates))
+        return chain(candidates, rest, quantities)
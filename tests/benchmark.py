@@ -0,0 +1,293 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark the FIFO assignment of moves.
+
+It uses the same database as the tests (DB_NAME and TRYTOND_DATABASE_URI
+environment variables) and prints the wall time, the number of queries and
+the peak of memory used by Move.assign_try:
+
+    python -m trytond.modules.stock_lot_fifo.tests.benchmark \\
+        --products 10 --lots 100 --locations 10 --moves 200 \\
+        --output benchmark.json
+
+The result of a previous run can be compared with --compare.
+
+The memory used to sort quantities can be measured without database:
+
+    python -m trytond.modules.stock_lot_fifo.tests.benchmark --sort 1000000
+"""
+import argparse
+import datetime
+import heapq
+import json
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    DB_NAME, activate_module, with_transaction)
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_lot_fifo.tests.tools import (
+    count_queries, set_options)
+from trytond.modules.stock_lot_fifo.tools import iter_sorted
+
+
+def create_dataset(products, lots, locations, moves, sled=False, seed=0):
+    """
+    Create products with lots received in storage locations and the draft
+    moves to assign. Return the company id and the move ids.
+    """
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Lot = pool.get('stock.lot')
+    LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+    Move = pool.get('stock.move')
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    rng = random.Random(seed)
+    today = datetime.date.today()
+
+    company = create_company()
+    with set_company(company):
+        unit, = Uom.search([('name', '=', 'Unit')])
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        bins = Location.create([{
+                    'name': 'Bin %s' % i,
+                    'type': 'storage',
+                    'parent': storage.id,
+                    } for i in range(locations)])
+
+        templates = Template.create([{
+                    'name': 'Product %s' % i,
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'lot_required': ['storage'],
+                    'products': [('create', [{}])],
+                    } for i in range(products)])
+        products = Product.search([('template', 'in', templates)])
+
+        lot_values = []
+        for product in products:
+            for i in range(lots):
+                values = {
+                    'number': '%s-%s' % (product.id, i),
+                    'product': product.id,
+                    }
+                if sled:
+                    values['shelf_life_expiration_date'] = (
+                        today + datetime.timedelta(days=rng.randint(1, 365)))
+                lot_values.append(values)
+        lots = Lot.create(lot_values)
+        if not sled:
+            to_write = []
+            for lot in lots:
+                to_write.extend([[lot], {
+                            'fifo_date': today - datetime.timedelta(
+                                days=rng.randint(0, 365)),
+                            }])
+            Lot.write(*to_write)
+
+        def move_values(product, from_location, to_location, quantity):
+            return {
+                'product': product.id,
+                'unit': unit.id,
+                'quantity': quantity,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                }
+
+        incoming_moves = []
+        for lot in lots:
+            values = move_values(
+                lot.product, supplier, rng.choice(bins), rng.randint(1, 20))
+            values['lot'] = lot.id
+            incoming_moves.append(values)
+        Move.do(Move.create(incoming_moves))
+
+        moves = Move.create([
+                move_values(
+                    rng.choice(products), storage, customer,
+                    rng.randint(1, 10))
+                for _ in range(moves)])
+        LotFifoQuantity.rebuild()
+    return company.id, [m.id for m in moves]
+
+
+@with_transaction()
+def measure(company_id, move_ids, context=None, memory=False):
+    "Assign the moves and rollback"
+    pool = Pool()
+    Company = pool.get('company.company')
+    Move = pool.get('stock.move')
+
+    with Transaction().set_context(context or {}), \
+            set_company(Company(company_id)):
+        moves = Move.browse(move_ids)
+        if memory:
+            tracemalloc.start()
+        with count_queries() as counter:
+            start = time.perf_counter()
+            Move.assign_try(moves)
+            duration = time.perf_counter() - start
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            peak = None
+        assigned = Move.search([
+                ('id', 'in', move_ids),
+                ('state', '=', 'assigned'),
+                ], count=True)
+    return {
+        'time': duration,
+        'queries': counter['queries'],
+        'peak_memory': peak,
+        'assigned': assigned,
+        }
+
+
+def measure_sort(rows, seed=0, picked=3):
+    """
+    Measure the time and the peak of memory to pick the first quantities
+    sorted by FIFO key with a heap of tuples and with iter_sorted, for lots
+    sharing 3650 dates and for lots with distinct dates ranked by location
+    """
+    rng = random.Random(seed)
+    today = datetime.date.today().toordinal()
+    quantities = [
+        ((rng.randint(1, 100), 1, l), float(rng.randint(1, 20)))
+        for l in range(rows)]
+    lot2dates = {
+        'dates': [today - rng.randint(0, 3650) for l in range(rows)],
+        'distinct_ranked': [today - l for l in range(rows)],
+        }
+
+    def fifo_key(case):
+        lot2date = lot2dates[case]
+        if case == 'dates':
+            return lambda q: lot2date[q[0][2]]
+        # The location rank of the quantity like with location_rank
+        return lambda q: lot2date[q[0][2]] * 101 + q[0][0]
+
+    def with_heap(key):
+        heap = [(key(q), n, q) for n, q in enumerate(quantities)]
+        heapq.heapify(heap)
+        return [heapq.heappop(heap)[-1] for _ in range(picked)]
+
+    def with_iter_sorted(key):
+        iterator = iter_sorted(quantities, key=key)
+        return [next(iterator) for _ in range(picked)]
+
+    results = {}
+    for case in lot2dates:
+        key = fifo_key(case)
+        for name, sort in [
+                ('heap', with_heap), ('iter_sorted', with_iter_sorted)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            sort(key)
+            duration = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results['%s_%s' % (case, name)] = {
+                'time': duration, 'peak_memory': peak}
+    return results
+
+
+def compare(results, previous):
+    "Print the ratio of results against previous results"
+    for key in ['time', 'queries', 'peak_memory']:
+        value, reference = results[key], previous['results'].get(key)
+        if value is None or not reference:
+            continue
+        print('%s: %s (previous %s, %+.1f%%)' % (
+                key, value, reference, (value / reference - 1) * 100))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=5)
+    parser.add_argument('--lots', type=int, default=50,
+        help="number of lots per product")
+    parser.add_argument('--locations', type=int, default=5,
+        help="number of storage locations")
+    parser.add_argument('--moves', type=int, default=100,
+        help="number of moves to assign")
+    parser.add_argument('--sled', action='store_true',
+        help="activate stock_lot_sled and set shelf life dates")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--context', action='append', default=[],
+        metavar='KEY=JSON', help="context used to assign the moves")
+    parser.add_argument('--option', action='append', default=[],
+        metavar='NAME=VALUE',
+        help="option of the stock_lot_fifo section of the configuration")
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--compare', help="previous results to compare")
+    parser.add_argument('--sort', type=int, metavar='ROWS',
+        help="measure only the sort of ROWS quantities")
+    options = parser.parse_args(arguments)
+
+    if options.sort:
+        print(json.dumps(
+                measure_sort(options.sort, seed=options.seed), indent=2))
+        return
+
+    context = {}
+    for item in options.context:
+        key, value = item.split('=', 1)
+        context[key] = json.loads(value)
+    config_options = dict(o.split('=', 1) for o in options.option)
+    with set_options(**config_options):
+        return _main(options, context, config_options)
+
+
+def _main(options, context, config_options):
+    modules = ['stock_lot_fifo']
+    if options.sled:
+        modules.append('stock_lot_sled')
+    activate_module(modules)
+    with Transaction().start(DB_NAME, 1) as transaction:
+        company_id, move_ids = create_dataset(
+            options.products, options.lots, options.locations,
+            options.moves, sled=options.sled, seed=options.seed)
+        transaction.commit()
+
+    runs = [measure(company_id, move_ids, context=context)
+        for _ in range(max(options.repeat, 1))]
+    results = min(runs, key=lambda r: r['time'])
+    results['peak_memory'] = measure(
+        company_id, move_ids, context=context, memory=True)['peak_memory']
+
+    parameters = {k: getattr(options, k) for k in [
+            'products', 'lots', 'locations', 'moves', 'sled', 'seed']}
+    parameters['context'] = context
+    parameters['options'] = config_options
+    print(json.dumps(results, indent=2))
+    if options.compare:
+        with open(options.compare) as file:
+            compare(results, json.load(file))
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump({
+                    'date': datetime.datetime.now().isoformat(),
+                    'parameters': parameters,
+                    'results': results,
+                    }, file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
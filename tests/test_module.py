@@ -1,11 +1,118 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import unittest
 from decimal import Decimal
+from trytond import backend
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.model.modelsql import SQLConstraintError
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from trytond.modules.company.tests import (CompanyTestMixin, create_company,
     set_company)
+from trytond.modules.stock_lot_fifo.stock import _share_fifo_orders
+from trytond.modules.stock_lot_fifo.tests.tools import (
+    count_instances, count_queries, set_options)
+from trytond.modules.stock_lot_fifo.tools import (
+    collect_stats, get_traces, iter_sorted)
+
+
+def create_product(name='Test lot_fifo', lot_required=('storage',)):
+    pool = Pool()
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': name,
+                'type': 'goods',
+                'default_uom': unit.id,
+                'lot_required': list(lot_required),
+                }])
+    product, = Product.create([{
+                'template': template.id,
+                }])
+    return product
+
+
+def create_lots(product, location, lots):
+    "Create lots with FIFO date and quantity received in location"
+    pool = Pool()
+    Company = pool.get('company.company')
+    Location = pool.get('stock.location')
+    Lot = pool.get('stock.lot')
+    Move = pool.get('stock.move')
+
+    company = Company(Transaction().context['company'])
+    supplier, = Location.search([('code', '=', 'SUP')])
+    records = Lot.create([{
+                'number': str(i),
+                'product': product.id,
+                } for i, _ in enumerate(lots, 1)])
+    for lot, (fifo_date, _) in zip(records, lots):
+        Lot.write([lot], {'fifo_date': fifo_date})
+    moves = Move.create([{
+                'product': product.id,
+                'lot': lot.id,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': supplier.id,
+                'to_location': location.id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                } for lot, (_, quantity) in zip(records, lots)])
+    Move.do(moves)
+    return records
+
+
+def create_moves(product, from_location, to_location, quantities):
+    pool = Pool()
+    Move = pool.get('stock.move')
+    return Move.create([{
+                'product': product.id,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                } for quantity in quantities])
+
+
+def plan_lots(move, **options):
+    "Return the lots and quantities planned for the move with the options"
+    pool = Pool()
+    Move = pool.get('stock.move')
+    with Transaction().set_context(**{
+                'stock_lot_fifo_%s' % k: v for k, v in options.items()}):
+        return [(l, q) for _, l, _, q in Move.plan_assign([move])]
+
+
+def delete_committed(company, products):
+    "Delete the records of the company and products committed by a test"
+    pool = Pool()
+    Company = pool.get('company.company')
+    Currency = pool.get('currency.currency')
+    Lot = pool.get('stock.lot')
+    LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+    Move = pool.get('stock.move')
+    Party = pool.get('party.party')
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+
+    moves = Move.search([('product', 'in', [p.id for p in products])])
+    Move.cancel(moves)
+    Move.delete(moves)
+    LotFifoQuantity.delete(
+        LotFifoQuantity.search([('company', '=', company.id)]))
+    Lot.delete(Lot.search([('product', 'in', [p.id for p in products])]))
+    templates = [p.template for p in products]
+    Product.delete(products)
+    Template.delete(templates)
+    party, currency = company.party, company.currency
+    Company.delete([company])
+    Party.delete([party])
+    Currency.delete([currency])
 
 
 class StockLotFifoTestCase(CompanyTestMixin, ModuleTestCase):
@@ -147,5 +254,990 @@ class StockLotFifoTestCase(CompanyTestMixin, ModuleTestCase):
             move, = draft
             self.assertEqual(move.lot, lot3)
 
+    @with_transaction()
+    def test0020lot_fifo_date(self):
+        'Test lot fifo date'
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test lot_fifo',
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    }])
+        lot, = Lot.create([{
+                    'number': '1',
+                    'product': product.id,
+                    }])
+
+        self.assertEqual(lot.fifo_date, lot.create_date.date())
+        self.assertEqual(lot.fifo_date, lot.sort_quantities_fifo())
+        self.assertEqual(
+            Lot.get_fifo_dates([lot.id]), {lot.id: lot.fifo_date})
+
+        fifo_date = lot.fifo_date - datetime.timedelta(days=1)
+        Lot.write([lot], {'fifo_date': fifo_date})
+        self.assertEqual(Lot.get_fifo_dates([lot.id]), {lot.id: fifo_date})
+
+    @with_transaction()
+    def test0030lot_fifo_sql_order(self):
+        'Test lot fifo with quantities sorted by the query'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lot1, lot2, lot3 = create_lots(product, storage, [
+                    (today, 5),
+                    (today - datetime.timedelta(days=2), 5),
+                    (today - datetime.timedelta(days=1), 5),
+                    ])
+
+            moves = create_moves(product, storage, lost_found, [7])
+            with Transaction().set_context(stock_lot_fifo_sql_order=True):
+                self.assertEqual(Move.assign_try(moves), True)
+            moves = Move.search([
+                    ('product', '=', product.id),
+                    ('to_location', '=', lost_found.id),
+                    ], order=[('quantity', 'DESC')])
+            self.assertEqual(
+                [(m.lot, m.quantity) for m in moves],
+                [(lot2, 5), (lot3, 2)])
+
+    @with_transaction()
+    def test0040lot_fifo_mixed_moves(self):
+        'Test lot fifo with moves with and without lot'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product(lot_required=())
+            today = datetime.date.today()
+            lot1, lot2 = create_lots(product, storage, [
+                    (today, 6),
+                    (today - datetime.timedelta(days=1), 4),
+                    ])
+
+            move1, = create_moves(product, storage, lost_found, [3])
+            move1.lot = lot1
+            move1.save()
+            move2, = create_moves(product, storage, lost_found, [9])
+            self.assertEqual(Move.assign_try([move1, move2]), False)
+
+            self.assertEqual(
+                (move1.state, move1.lot, move1.quantity),
+                ('assigned', lot1, 3))
+            self.assertEqual(
+                (move2.state, move2.lot, move2.quantity), ('draft', None, 2))
+            move3, = Move.search([
+                    ('product', '=', product.id),
+                    ('to_location', '=', lost_found.id),
+                    ('id', 'not in', [move1.id, move2.id]),
+                    ])
+            self.assertEqual(
+                (move3.state, move3.lot, move3.quantity),
+                ('assigned', None, 7))
+
+    @with_transaction()
+    def test0050lot_fifo_split_lot_queries(self):
+        'Test lot fifo split moves with constant queries'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            products = [
+                create_product(lot_required=()),
+                create_product(lot_required=('lost_found',)),
+                ]
+
+            def count(size):
+                moves = []
+                for product in products:
+                    moves += create_moves(
+                        product, storage, lost_found, [1] * size)
+                    moves += create_moves(
+                        product, lost_found, storage, [1] * size)
+                Transaction().cache.clear()
+                moves = [Move(m.id) for m in moves]
+                with count_queries() as counter:
+                    with_lot, without_lot = Move._assign_try_split_lot(moves)
+                self.assertEqual(len(with_lot), 2 * size)
+                self.assertEqual(len(without_lot), 2 * size)
+                return counter['queries']
+
+            count(1)  # fill the caches
+            self.assertEqual(count(5), count(50))
+
+    @with_transaction()
+    def test0060lot_fifo_stats(self):
+        'Test lot fifo assignment statistics'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            create_lots(product, storage, [(today, 5), (today, 5)])
+
+            moves = create_moves(product, storage, lost_found, [2, 3])
+            with collect_stats() as stats:
+                self.assertEqual(Move.assign_try(moves), True)
+
+            self.assertEqual(stats.counters['moves_with_lot'], 2)
+            self.assertEqual(stats.counters['moves_without_lot'], 0)
+            # The lots are sorted once for both moves
+            self.assertEqual(stats.counters['lots'], 2)
+            self.assertEqual(stats.counters['quantities_sorted'], 2)
+            self.assertEqual(stats.counters['quantities_reused'], 2)
+            self.assertIn('split', stats.times)
+            self.assertIn('sort', stats.times)
+
+    @set_options(quantity_index=True)
+    @with_transaction()
+    def test0070lot_fifo_quantity_index(self):
+        'Test lot fifo quantity index'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+
+        def index_quantities():
+            return {(q.location.id, q.lot and q.lot.id): q.quantity
+                for q in LotFifoQuantity.search([]) if q.quantity}
+
+        def stock_quantities():
+            with Transaction().set_context(
+                    stock_date_end=datetime.date.today(), stock_assign=True):
+                pbl = Product.products_by_location(
+                    [l.id for l in Location.search([])],
+                    grouping=('product', 'lot'),
+                    grouping_filter=([product.id],))
+            return {(k[0], k[2]): q for k, q in pbl.items() if q}
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lot1, lot2, lot3 = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=1), 5),
+                    (today - datetime.timedelta(days=2), 5),
+                    (today, 5),
+                    ])
+            self.assertEqual(index_quantities(), stock_quantities())
+            self.assertEqual(
+                {q.lot: q.fifo_date for q in LotFifoQuantity.search([])
+                    if q.location == storage},
+                {l: l.fifo_date for l in [lot1, lot2, lot3]})
+
+            move, = create_moves(product, storage, lost_found, [7])
+            with collect_stats() as stats:
+                self.assertEqual(Move.assign_try([move]), True)
+            self.assertEqual(stats.counters['index_quantities'], 3)
+            moves = Move.search([
+                    ('product', '=', product.id),
+                    ('state', '=', 'assigned'),
+                    ], order=[('quantity', 'DESC')])
+            self.assertEqual(
+                [(m.lot, m.quantity) for m in moves], [(lot2, 5), (lot1, 2)])
+            self.assertEqual(index_quantities(), stock_quantities())
+            self.assertEqual(index_quantities()[(storage.id, lot1.id)], 3)
+
+            Move.cancel(moves)
+            self.assertEqual(index_quantities(), stock_quantities())
+
+            Lot.write([lot3], {'fifo_date': today - datetime.timedelta(
+                        days=3)})
+            lot_quantity, = LotFifoQuantity.search([
+                    ('lot', '=', lot3.id),
+                    ('location', '=', storage.id),
+                    ])
+            self.assertEqual(lot_quantity.fifo_date, lot3.fifo_date)
+
+            expected = index_quantities()
+            LotFifoQuantity.rebuild()
+            self.assertEqual(index_quantities(), expected)
+
+    @with_transaction()
+    def test0075lot_fifo_quantity_index_key(self):
+        'Test lot fifo quantity index has one row by key'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            product = create_product()
+            lot, = create_lots(product, storage, [(None, 1)])
+            LotFifoQuantity.rebuild()
+            for lot_id in [None, lot.id]:
+                key = (company.id, storage.id, product.id, lot_id)
+                LotFifoQuantity.add_quantities({key: 2})
+                LotFifoQuantity.add_quantities({key: 3})
+            rows = LotFifoQuantity.search([
+                    ('location', '=', storage.id),
+                    ])
+            self.assertEqual(
+                sorted((r.lot.id if r.lot else -1, r.quantity) for r in rows),
+                [(-1, 5), (lot.id, 6)])
+
+            # The key without lot is unique too
+            with self.assertRaises(SQLConstraintError):
+                LotFifoQuantity.create([{
+                            'company': company.id,
+                            'location': storage.id,
+                            'product': product.id,
+                            'quantity': 1,
+                            }])
+
+    @with_transaction()
+    def test0080lot_fifo_sort_quantities_lazy(self):
+        'Test lot fifo sort quantities yields only consumed quantities'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lots = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=i), 1)
+                    for i in range(10)])
+            move, = create_moves(product, storage, lost_found, [1])
+
+            quantities = [((storage.id, product.id, l.id), q)
+                for l, q in zip(lots, [1, 0, -1, 1, 1, 1, 1, 1, 1, 1])]
+            with collect_stats() as stats:
+                quantities = move.sort_quantities(
+                    quantities, [storage], ('product', 'lot'))
+                self.assertEqual(stats.counters['lots'], 8)
+                self.assertEqual(next(quantities)[0][2], lots[-1].id)
+            self.assertEqual(
+                [q[0][2] for q in quantities],
+                [l.id for l in reversed(lots[3:-1])] + [lots[0].id])
+
+    def test0085iter_sorted(self):
+        'Test iter_sorted keeps the order of the items with the same key'
+        items = [(3, 'a'), (1, 'b'), (2, 'c'), (1, 'd'), (3, 'e'), (-1, 'f')]
+        iterator = iter_sorted(items, key=lambda i: i[0])
+        self.assertEqual(next(iterator), (-1, 'f'))
+        self.assertEqual(
+            list(iterator), sorted(items[:-1], key=lambda i: i[0]))
+
+    @with_transaction()
+    def test0090lot_fifo_plan_assign(self):
+        'Test lot fifo plan assign'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lot1, lot2, lot3 = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=1), 5),
+                    (today - datetime.timedelta(days=2), 5),
+                    (today, 5),
+                    ])
+            move1, move2 = create_moves(product, storage, lost_found, [7, 4])
+
+            plan = Move.plan_assign([move1, move2])
+            self.assertEqual(plan, [
+                    (move1, lot2, storage, 5),
+                    (move1, lot1, storage, 2),
+                    (move2, lot1, storage, 3),
+                    (move2, lot3, storage, 1),
+                    ])
+            self.assertEqual(Move.search([
+                        ('product', '=', product.id),
+                        ('state', '!=', 'done'),
+                        ], count=True), 2)
+            self.assertEqual({move1.state, move2.state}, {'draft'})
+
+            self.assertEqual(Move.assign_try([move1, move2]), True)
+            moves = Move.search([
+                    ('product', '=', product.id),
+                    ('state', '=', 'assigned'),
+                    ])
+            self.assertEqual(
+                sorted((m.lot.id, m.quantity) for m in moves),
+                sorted((l.id, q) for _, l, _, q in plan))
+
+    @unittest.skipIf(backend.name == 'sqlite', "SQLite locks the table")
+    @set_options(quantity_index=True, lock_index=True)
+    @with_transaction()
+    def test0100lot_fifo_lock_index(self):
+        'Test lot fifo assignment of different products concurrently'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product1 = create_product('Product 1')
+            product2 = create_product('Product 2')
+            today = datetime.date.today()
+            for product in [product1, product2]:
+                create_lots(product, storage, [(today, 5)])
+            move1, move3 = create_moves(product1, storage, lost_found, [3, 3])
+            move2, = create_moves(product2, storage, lost_found, [3])
+            transaction.commit()
+
+            def assign(move):
+                with transaction.new_transaction() as worker:
+                    result = Move.assign_try([Move(move.id)])
+                    worker.commit()
+                    return result
+
+            try:
+                self.assertEqual(Move.assign_try([move1]), True)
+                # The quantities of product 1 are locked by the first worker
+                self.assertEqual(assign(move2), True)
+                with self.assertRaises(backend.DatabaseOperationalError):
+                    assign(move3)
+                transaction.commit()
+
+                self.assertEqual(assign(move3), False)
+                moves = Move.search([
+                        ('product', '=', product1.id),
+                        ('state', '=', 'assigned'),
+                        ])
+                self.assertEqual(sum(m.quantity for m in moves), 5)
+            finally:
+                transaction.rollback()
+                delete_committed(company, [product1, product2])
+                transaction.commit()
+
+    @with_transaction(context={'stock_lot_fifo_assign_chunk': 2})
+    def test0110lot_fifo_assign_try_lots(self):
+        'Test lot fifo assignment by chunks in background'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Queue = pool.get('ir.queue')
+        Shipment = pool.get('stock.shipment.internal')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product1 = create_product('Product 1')
+            product2 = create_product('Product 2')
+            product3 = create_product('Product 3', lot_required=())
+            today = datetime.date.today()
+            lot1, lot2 = create_lots(product1, storage, [
+                    (today - datetime.timedelta(days=1), 5),
+                    (today, 5),
+                    ])
+            create_lots(product2, storage, [(today, 5)])
+            shipment, shipment2, draft_shipment = Shipment.create([{
+                        'company': company.id,
+                        'from_location': storage.id,
+                        'to_location': lost_found.id,
+                        }] * 3)
+
+            def create_shipment_moves(shipment, product, quantities):
+                moves = create_moves(product, storage, lost_found, quantities)
+                Move.write(moves, {'shipment': str(shipment)})
+                return moves
+            moves1 = create_shipment_moves(shipment, product1, [2] * 5)
+            moves2 = create_shipment_moves(shipment2, product2, [1])
+            create_shipment_moves(shipment, product3, [1])
+            Shipment.wait([shipment, shipment2])
+            # The moves of a draft shipment are not assigned
+            create_shipment_moves(draft_shipment, product2, [1])
+            create_moves(product2, storage, lost_found, [1])
+
+            self.assertEqual(
+                Move._assign_try_lots_chunks(moves1 + moves2, 2), [
+                    [[m.id for m in moves1[:2]], [m.id for m in moves1[2:4]],
+                        [moves1[4].id]],
+                    [[moves2[0].id]],
+                    ])
+
+            Move.assign_try_lots()
+            self.assertEqual(Queue.search([], count=True), 2)
+            while True:
+                tasks = Queue.search([('finished_at', '=', None)])
+                if not tasks:
+                    break
+                for task in tasks:
+                    task.run()
+
+            self.assertEqual(Queue.search([], count=True), 4)
+            moves = Move.search([
+                    ('product', '=', product1.id),
+                    ('state', '=', 'assigned'),
+                    ])
+            self.assertEqual(
+                sorted((m.lot, m.quantity) for m in moves),
+                sorted([(lot1, 2), (lot1, 2), (lot1, 1), (lot2, 1),
+                        (lot2, 2), (lot2, 2)]))
+            self.assertEqual(Move.search([
+                        ('product', 'in', [product2.id, product3.id]),
+                        ('state', '=', 'draft'),
+                        ], count=True), 3)
+            # Only the shipment with all its moves assigned is assigned
+            self.assertEqual(shipment.state, 'waiting')
+            self.assertEqual(shipment2.state, 'assigned')
+
+    @with_transaction()
+    def test0120lot_fifo_group_sort(self):
+        'Test lot fifo sort once by product and locations'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            bin1, bin2 = Location.create([{
+                        'name': name,
+                        'type': 'storage',
+                        'parent': storage.id,
+                        } for name in ['Bin 1', 'Bin 2']])
+            product = create_product()
+            today = datetime.date.today()
+            quantities = []
+            for location, days in [(bin1, [3, 1, 5]), (bin2, [2, 4, 1])]:
+                lots = create_lots(product, location, [
+                        (today - datetime.timedelta(days=d), 3)
+                        for d in days])
+                quantities.extend(
+                    ((location.id, product.id, l.id), 3.) for l in lots)
+            moves = create_moves(product, storage, lost_found, [2, 4, 1, 5])
+
+            with Transaction().set_context(stock_lot_fifo_group_sort=False):
+                expected = Move.plan_assign(moves)
+            with collect_stats() as stats:
+                self.assertEqual(Move.plan_assign(moves), expected)
+            self.assertEqual(stats.counters['quantities_sorted'], 6)
+            self.assertEqual(sum(q for *_, q in expected), 12)
+
+            # The order is shared while it is sorted lazily
+            move1, move2 = moves[:2]
+            with _share_fifo_orders(), collect_stats() as stats:
+                sorted1 = move1.sort_quantities(
+                    quantities, [bin1, bin2], ('product', 'lot'))
+                first = next(sorted1)
+                sorted2 = move2.sort_quantities(
+                    quantities, [bin1, bin2], ('product', 'lot'))
+                self.assertEqual(next(sorted2), first)
+                self.assertEqual(list(sorted1), list(sorted2))
+            self.assertEqual(stats.counters['quantities_sorted'], 6)
+            self.assertEqual(stats.counters['quantities_reused'], 6)
+
+    @with_transaction()
+    def test0130lot_fifo_packing_window(self):
+        'Test lot fifo packing window'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        cursor = Transaction().connection.cursor()
+        lot_table = Lot.__table__()
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lots = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=3), 5),
+                    (today - datetime.timedelta(days=2), 8),
+                    (today - datetime.timedelta(days=1), 20),
+                    (today, 5),
+                    ])
+            lot1, lot2, lot3, lot4 = lots
+            move, = create_moves(product, storage, lost_found, [15])
+
+            self.assertEqual(
+                plan_lots(move, packing_window=0),
+                [(lot1, 5), (lot2, 8), (lot3, 2)])
+            # No lot fulfills the move in the window
+            self.assertEqual(
+                plan_lots(move, packing_window=1),
+                [(lot2, 8), (lot1, 5), (lot3, 2)])
+            self.assertEqual(plan_lots(move, packing_window=2), [(lot3, 15)])
+
+            # The window follows the dates of the strategy
+            for lot, days in zip(lots, [30, 20, 10, 0]):
+                cursor.execute(*lot_table.update(
+                        [lot_table.create_date],
+                        [datetime.datetime.combine(
+                                today - datetime.timedelta(days=days),
+                                datetime.time())],
+                        where=lot_table.id == lot.id))
+            self.assertEqual(
+                plan_lots(move, packing_window=0, strategy='lifo'),
+                [(lot4, 5), (lot3, 10)])
+            self.assertEqual(
+                plan_lots(move, packing_window=1, strategy='lifo'),
+                [(lot4, 5), (lot3, 10)])
+            self.assertEqual(
+                plan_lots(move, packing_window=10, strategy='lifo'),
+                [(lot3, 15)])
+
+    @with_transaction()
+    def test0135lot_fifo_location_rank(self):
+        'Test lot fifo location rank'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        LotFifoQuantity = pool.get('stock.lot.fifo.quantity')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            # The tree order of the bins is the reverse of their name order
+            bin2, = Location.create([{
+                        'name': 'Bin 2',
+                        'type': 'storage',
+                        'parent': storage.id,
+                        }])
+            bin1, = Location.create([{
+                        'name': 'Bin 1',
+                        'type': 'storage',
+                        'parent': storage.id,
+                        }])
+            product = create_product()
+            today = datetime.date.today()
+            lot1, = create_lots(product, bin1, [(today, 3)])
+            lot2, = create_lots(product, bin2, [(today, 3)])
+            move, = create_moves(product, storage, lost_found, [2])
+
+            with collect_stats() as stats:
+                self.assertEqual(plan_lots(move), [(lot1, 2)])
+                self.assertEqual(
+                    plan_lots(move, location_rank=True), [(lot2, 2)])
+                self.assertEqual(
+                    plan_lots(move, location_rank=True), [(lot2, 2)])
+            self.assertEqual(stats.counters['location_rank_queries'], 1)
+            self.assertEqual(
+                plan_lots(move, location_rank=True, sql_order=True),
+                [(lot2, 2)])
+            LotFifoQuantity.rebuild()
+            with set_options(quantity_index=True):
+                self.assertEqual(
+                    plan_lots(move, location_rank=True), [(lot2, 2)])
+
+            Location.write([bin2], {'parent': bin1.id})
+            with collect_stats() as stats:
+                self.assertEqual(
+                    plan_lots(move, location_rank=True), [(lot1, 2)])
+            self.assertEqual(stats.counters['location_rank_queries'], 1)
+
+    @with_transaction()
+    def test0138lot_fifo_strategy(self):
+        'Test lot fifo strategy of category and warehouse'
+        pool = Pool()
+        Category = pool.get('product.category')
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Template = pool.get('product.template')
+        cursor = Transaction().connection.cursor()
+        lot_table = Lot.__table__()
+
+        company = create_company()
+        with set_company(company):
+            warehouse, = Location.search([('code', '=', 'WH')])
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lots = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=d), 1)
+                    for d in [2, 3, 1]])
+            lot1, lot2, lot3 = lots
+            for lot, days in zip(lots, [10, 5, 7]):
+                cursor.execute(*lot_table.update(
+                        [lot_table.create_date],
+                        [datetime.datetime.combine(
+                                today - datetime.timedelta(days=days),
+                                datetime.time())],
+                        where=lot_table.id == lot.id))
+            move, = create_moves(product, storage, lost_found, [3])
+
+            self.assertEqual(
+                plan_lots(move), [(lot2, 1), (lot1, 1), (lot3, 1)])
+
+            Location.write([warehouse], {'fifo_strategy': 'lifo'})
+            self.assertEqual(
+                plan_lots(move), [(lot2, 1), (lot3, 1), (lot1, 1)])
+
+            parent, = Category.create([{
+                        'name': 'Parent',
+                        'fifo_strategy': 'lot_date',
+                        }])
+            category, = Category.create([{
+                        'name': 'Category',
+                        'parent': parent.id,
+                        }])
+            Template.write([product.template], {
+                    'categories': [('add', [category.id])],
+                    })
+            self.assertEqual(
+                plan_lots(move), [(lot1, 1), (lot3, 1), (lot2, 1)])
+
+            Category.write([category], {'fifo_strategy': 'fefo'})
+            with Transaction().set_context(stock_lot_fifo_sql_order=True):
+                self.assertEqual(
+                    plan_lots(move), [(lot2, 1), (lot1, 1), (lot3, 1)])
+
+    @with_transaction()
+    def test0139lot_fifo_receipt_date(self):
+        'Test lot fifo receipt date'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            bin_, = Location.create([{
+                        'name': 'Bin',
+                        'type': 'storage',
+                        'parent': storage.id,
+                        }])
+            product = create_product()
+            today = datetime.date.today()
+
+            def days(n):
+                return today - datetime.timedelta(days=n)
+            lot1, lot2 = create_lots(product, storage, [
+                    (days(1), 2), (days(2), 2)])
+            lot3, = Lot.create([{
+                        'number': '3',
+                        'product': product.id,
+                        }])
+
+            def receive(lot, from_location, to_location, date):
+                values = {
+                    'product': product.id,
+                    'lot': lot.id,
+                    'unit': product.default_uom.id,
+                    'quantity': 1,
+                    'from_location': from_location.id,
+                    'to_location': to_location.id,
+                    'effective_date': date,
+                    }
+                if from_location == supplier:
+                    values['unit_price'] = Decimal(1)
+                    values['currency'] = company.currency.id
+                Move.do(Move.create([values]))
+            receive(lot3, supplier, storage, days(5))
+            receive(lot1, supplier, storage, days(10))
+            # An internal move is not a receipt
+            receive(lot2, storage, bin_, days(20))
+
+            self.assertEqual(
+                [l['receipt_date'] for l in Lot.read(
+                        [lot1.id, lot2.id, lot3.id], ['receipt_date'])],
+                [days(10), today, days(5)])
+
+            move, = create_moves(product, storage, lost_found, [6])
+
+            self.assertEqual(
+                plan_lots(move), [(lot2, 1), (lot2, 1), (lot1, 3), (lot3, 1)])
+            self.assertEqual(
+                plan_lots(move, strategy='receipt'),
+                [(lot1, 3), (lot3, 1), (lot2, 1), (lot2, 1)])
+
+    @with_transaction()
+    def test0140lot_fifo_exclude_expired(self):
+        'Test lot fifo excludes expired lots'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            lot1, lot2, lot3 = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=2), 5),
+                    (today - datetime.timedelta(days=1), 5),
+                    (today, 5),
+                    ])
+            Lot.write([lot1], {
+                    'fifo_expiration_date': (
+                        today - datetime.timedelta(days=1)),
+                    }, [lot2], {
+                    'fifo_expiration_date': (
+                        today + datetime.timedelta(days=2)),
+                    })
+            move, = create_moves(product, storage, lost_found, [6])
+
+            self.assertEqual(plan_lots(move), [(lot1, 5), (lot2, 1)])
+            with collect_stats() as stats:
+                self.assertEqual(
+                    plan_lots(move, exclude_expired=True),
+                    [(lot2, 5), (lot3, 1)])
+            self.assertEqual(stats.counters['quantities_skipped'], 1)
+            self.assertEqual(
+                plan_lots(move, exclude_expired=True, expiration_cutoff=3),
+                [(lot3, 5)])
+
+    @with_transaction()
+    def test0150lot_fifo_backfill_fifo_dates(self):
+        'Test lot fifo backfill of FIFO dates'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            product = create_product()
+            today = datetime.date.today()
+            lots = create_lots(product, storage, [
+                    (today - datetime.timedelta(days=i), 1)
+                    for i in range(5)])
+            self.assertNotEqual(
+                {l.fifo_date for l in lots}, {today})
+            # The chunks are computed in other transactions
+            Transaction().commit()
+
+            try:
+                Lot.backfill_fifo_dates(chunk_size=2)
+                Transaction().cache.clear()
+
+                self.assertEqual(
+                    {l.fifo_date for l in Lot.browse(lots)},
+                    {l.create_date.date() for l in lots})
+                self.assertEqual(Lot.get_fifo_dates([lots[-1].id]), {
+                        lots[-1].id: lots[-1].create_date.date()})
+            finally:
+                delete_committed(company, [product])
+                Transaction().commit()
+
+    @with_transaction()
+    def test0160lot_fifo_assign_queries(self):
+        'Test lot fifo assignment queries do not grow with moves and lots'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            today = datetime.date.today()
+
+            def count(method, size, lot_required):
+                product = create_product(lot_required=lot_required)
+                create_lots(product, storage, [
+                        (today - datetime.timedelta(days=i), 2)
+                        for i in range(size)])
+                moves = create_moves(
+                    product, storage, lost_found, [1] * size)
+                Transaction().cache.clear()
+                moves = [Move(m.id) for m in moves]
+                with count_queries() as queries, \
+                        count_instances(Lot) as lots:
+                    method(moves)
+                return queries['queries'], lots['instances']
+
+            for lot_required in [('storage',), ()]:
+                lot_instances = 1 if lot_required else 0
+                count(Move.plan_assign, 1, lot_required)  # fill the caches
+                queries5, lots5 = count(Move.plan_assign, 5, lot_required)
+                queries20, lots20 = count(Move.plan_assign, 20, lot_required)
+                self.assertEqual(queries5, queries20)
+                # Lots are only instantiated for the plan
+                self.assertEqual(lots5, 5 * lot_instances)
+                self.assertEqual(lots20, 20 * lot_instances)
+
+                # assign_try writes each move and validates its lot
+                queries5, lots5 = count(Move.assign_try, 5, lot_required)
+                queries20, lots20 = count(Move.assign_try, 20, lot_required)
+                self.assertLessEqual(queries20 - queries5, 2 * 15)
+                self.assertLessEqual(lots20 - lots5, 2 * 15 * lot_instances)
+
+    @with_transaction()
+    def test0170lot_fifo_trace(self):
+        'Test lot fifo allocation trace'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        lot_table = Lot.__table__()
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            yesterday = today - datetime.timedelta(days=1)
+            lot1, lot2 = create_lots(product, storage, [
+                    (yesterday, 5), (today, 5)])
+            move, = create_moves(product, storage, lost_found, [6])
+
+            traces = get_traces()
+            Move.plan_assign([move])
+            self.assertEqual(get_traces(), traces)
+
+            with Transaction().set_context(
+                    stock_lot_fifo_trace_rate=1.,
+                    stock_lot_fifo_trace_size=2):
+                for _ in range(3):
+                    Move.plan_assign([move])
+            traces = get_traces()
+            self.assertEqual(len(traces), 2)
+            trace = traces[-1]
+            self.assertEqual(trace['move'], move.id)
+            self.assertEqual(trace['strategy'], 'fefo')
+            self.assertEqual(trace['candidates_count'], 2)
+            self.assertEqual(
+                [(c['lot'], c['date'], c['source'])
+                    for c in trace['candidates']],
+                [(lot1.id, yesterday, 'fifo_date'),
+                    (lot2.id, today, 'create_date')])
+            self.assertEqual(
+                [(p['lot'], p['quantity']) for p in trace['picked']],
+                [(lot1.id, 5), (lot2.id, 1)])
+            self.assertGreaterEqual(trace['time'], 0)
+
+            # The candidates are traced with the key of the strategy
+            created = today - datetime.timedelta(days=3)
+            cursor.execute(*lot_table.update(
+                    [lot_table.create_date],
+                    [datetime.datetime.combine(created, datetime.time())],
+                    where=lot_table.id == lot1.id))
+            with Transaction().set_context(
+                    stock_lot_fifo_trace_rate=1.,
+                    stock_lot_fifo_strategy='lifo'):
+                Move.plan_assign([move])
+            trace = get_traces()[-1]
+            self.assertEqual(trace['strategy'], 'lifo')
+            self.assertEqual(
+                [(c['lot'], c['key'], c['date'], c['source'])
+                    for c in trace['candidates']],
+                [(lot2.id, -today.toordinal(), today, 'create_date'),
+                    (lot1.id, -created.toordinal(), created, 'create_date')])
+            self.assertEqual(
+                [(p['lot'], p['quantity']) for p in trace['picked']],
+                [(lot2.id, 5), (lot1.id, 1)])
+
+    @with_transaction()
+    def test0175lot_fifo_trace_consumable(self):
+        'Test lot fifo allocation trace of consumable'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            product.template.consumable = True
+            product.template.save()
+            lot, = create_lots(product, storage, [
+                    (datetime.date.today(), 2)])
+            move, = create_moves(product, storage, lost_found, [5])
+
+            with Transaction().set_context(stock_lot_fifo_trace_rate=1.):
+                Move.assign_try([move])
+            trace = get_traces()[-1]
+            self.assertEqual(trace['move'], move.id)
+            self.assertEqual(
+                [(p['location'], p['lot'], p['quantity'])
+                    for p in trace['picked']],
+                [(storage.id, lot.id, 2), (storage.id, None, 3)])
+
+    @with_transaction()
+    def test0180lot_fifo_prewarm(self):
+        'Test lot fifo prewarm on receipt'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            product = create_product()
+            today = datetime.date.today()
+            create_lots(product, storage, [(today, 5)])
+            self.assertEqual(Queue.search([], count=True), 0)
+
+            with Transaction().set_context(stock_lot_fifo_prewarm=True):
+                lots = create_lots(product, storage, [(today, 5), (today, 5)])
+                # Moves leaving storage do not prewarm
+                move, = create_moves(product, storage, lost_found, [1])
+                Move.write([move], {'lot': lots[0].id})
+                Move.do([move])
+            task, = Queue.search([])
+            self.assertEqual(task.data['method'], 'prewarm_fifo')
+            # The task is run by a worker in another transaction
+            transaction.commit()
+
+            try:
+                with transaction.new_transaction() as worker:
+                    with collect_stats() as stats:
+                        Queue(task.id).run()
+                    worker.commit()
+                self.assertEqual(stats.counters['lots_queried'], 2)
+                self.assertIn('products_by_location', stats.times)
+                # The keys are cached for the next tasks of the worker process
+                with transaction.new_transaction():
+                    with collect_stats() as stats:
+                        Lot.get_fifo_keys([l.id for l in lots])
+                    self.assertEqual(stats.counters['lots_queried'], 0)
+            finally:
+                Queue.delete([task])
+                delete_committed(company, [product])
+                transaction.commit()
+
 
 del ModuleTestCase
@@ -131,6 +131,14 @@ class Test(unittest.TestCase):
         lot3.product = product
         lot3.shelf_life_expiration_date = today + relativedelta(days=2)
         lot3.save()
+        self.assertEqual(lot3.fifo_date, today + relativedelta(days=2))
+        self.assertEqual(
+            lot3.fifo_expiration_date, today + relativedelta(days=2))
+        lot3.shelf_life_expiration_date = today + relativedelta(days=3)
+        lot3.save()
+        self.assertEqual(lot3.fifo_date, today + relativedelta(days=3))
+        lot3.shelf_life_expiration_date = today + relativedelta(days=2)
+        lot3.save()
 
         # Create new supplier moves with lot
         move3_in = Move()
@@ -0,0 +1,62 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from trytond import backend, config
+
+from trytond.modules.stock_lot_fifo.tools import SECTION
+
+
+@contextmanager
+def count_queries():
+    "Count the queries executed by the database cursors"
+    if backend.name == 'sqlite':
+        from trytond.backend.sqlite.database import SQLiteCursor as Cursor
+    else:
+        from trytond.backend.postgresql.database import LoggingCursor as Cursor
+    counter = {'queries': 0}
+    execute = Cursor.execute
+
+    def counted_execute(self, *args, **kwargs):
+        counter['queries'] += 1
+        return execute(self, *args, **kwargs)
+
+    with patch.object(Cursor, 'execute', counted_execute):
+        yield counter
+
+
+@contextmanager
+def count_instances(Model):
+    "Count the instances of Model created"
+    counter = {'instances': 0}
+    init = Model.__init__
+
+    def counted_init(self, *args, **kwargs):
+        counter['instances'] += 1
+        return init(self, *args, **kwargs)
+
+    with patch.object(Model, '__init__', counted_init):
+        yield counter
+
+
+@contextmanager
+def set_options(**options):
+    "Set the options in the configuration"
+    previous = None
+    if config.has_section(SECTION):
+        previous = {n: config.get(SECTION, n) for n in config.options(SECTION)}
+    else:
+        config.add_section(SECTION)
+    for name, value in options.items():
+        config.set(SECTION, name, str(value))
+    try:
+        yield
+    finally:
+        # Setting an option clears the cache of the configuration
+        config.set(SECTION, next(iter(options)), '')
+        config.remove_section(SECTION)
+        if previous is not None:
+            config.add_section(SECTION)
+            for name, value in previous.items():
+                config.set(SECTION, name, value)
@@ -0,0 +1,148 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import heapq
+import logging
+import time
+from array import array
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from weakref import WeakKeyDictionary
+
+from trytond import config
+from trytond.transaction import Transaction
+
+SECTION = 'stock_lot_fifo'
+logger = logging.getLogger(__name__)
+
+
+# Options which maintain persistent data or control locking can not be
+# changed by the context of the clients
+CONFIG_OPTIONS = {'quantity_index', 'lock_index'}
+
+
+def get_option(name, default=None):
+    """Return the value of the option name
+
+    The value is read from the context key "stock_lot_fifo_<name>" or from
+    the "stock_lot_fifo" section of the configuration file.
+    The options of CONFIG_OPTIONS are only read from the configuration file.
+    """
+    context = Transaction().context
+    key = '%s_%s' % (SECTION, name)
+    if name not in CONFIG_OPTIONS and key in context:
+        return context[key]
+    if isinstance(default, bool):
+        return config.getboolean(SECTION, name, default=default)
+    elif isinstance(default, int):
+        return config.getint(SECTION, name, default=default)
+    elif isinstance(default, float):
+        return config.getfloat(SECTION, name, default=default)
+    return config.get(SECTION, name, default=default)
+
+
+def iter_sorted(items, key):
+    """Return an iterator of the items sorted by key as they are consumed
+
+    key must return an integer. The keys are stored in an array of integers
+    and each item is pushed in a heap as a single integer made of its key and
+    its index, so no tuple is created per item and only the items consumed
+    are sorted.
+    The order of items with the same key is kept like with sorted.
+    """
+    keys = array('q', map(key, items))
+    if not keys:
+        return iter(())
+    low, size = min(keys), len(keys)
+    heap = [(k - low) * size + i for i, k in enumerate(keys)]
+    del keys
+    heapq.heapify(heap)
+
+    def iterator():
+        while heap:
+            yield items[heapq.heappop(heap) % size]
+    return iterator()
+
+
+_traces = None
+
+
+def add_trace(trace):
+    """Add the trace of an assignment to the buffer and log its summary
+
+    The buffer keeps the last "trace_size" traces.
+    """
+    global _traces
+    size = get_option('trace_size', 100)
+    if _traces is None or _traces.maxlen != size:
+        _traces = deque(_traces or [], maxlen=size)
+    _traces.append(trace)
+    logger.debug(
+        "assignment trace of move %s: picked lots %s in %.6fs",
+        trace['move'], [p['lot'] for p in trace['picked']], trace['time'])
+
+
+def get_traces():
+    "Return the traces of the last assignments"
+    return list(_traces or [])
+
+
+class AssignStats:
+    "Counters and elapsed times of the FIFO assignment"
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.times = defaultdict(float)
+
+    def add(self, name, value=1):
+        self.counters[name] += value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def __str__(self):
+        return ', '.join(
+            ['%s=%s' % i for i in sorted(self.counters.items())]
+            + ['%s=%.6fs' % i for i in sorted(self.times.items())])
+
+
+class _DisabledStats:
+    "Statistics which record nothing"
+
+    def add(self, name, value=1):
+        pass
+
+    def timer(self, name):
+        return nullcontext()
+
+
+_disabled_stats = _DisabledStats()
+_stats = WeakKeyDictionary()
+
+
+def get_stats():
+    "Return the statistics collected for the transaction"
+    return _stats.get(Transaction(), _disabled_stats)
+
+
+@contextmanager
+def collect_stats(enabled=True):
+    """Collect the statistics of the FIFO assignment in the transaction
+
+    Nested calls share the statistics of the outermost which logs them.
+    """
+    transaction = Transaction()
+    stats = _stats.get(transaction)
+    if stats is not None or not enabled:
+        yield stats or _disabled_stats
+        return
+    stats = _stats[transaction] = AssignStats()
+    try:
+        yield stats
+    finally:
+        del _stats[transaction]
+        logger.info("assignment statistics: %s", stats)